@@ -0,0 +1,290 @@
+"""Persistent on-disk caches used while testing reference files."""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.reftest_cache')
+
+
+def file_checksum(filename, blocksize=2**20):
+    """Hash the full contents of a file.
+
+    Parameters
+    ----------
+    filename: str
+        Path to file.
+    blocksize: int
+        Number of bytes to read at a time.
+
+    Returns
+    -------
+    checksum: str
+        sha1 hex digest of the file contents.
+    """
+
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def file_fingerprint(filename):
+    """Cheap fingerprint of a (possibly large) data file built from its
+    name, size and modification time.
+
+    Parameters
+    ----------
+    filename: str
+        Path to file.
+
+    Returns
+    -------
+    fingerprint: str
+        sha1 hex digest of the file name, size and mtime.
+    """
+
+    stat = os.stat(filename)
+    fields = [os.path.basename(filename), str(stat.st_size), str(int(stat.st_mtime))]
+
+    return hashlib.sha1('|'.join(fields).encode()).hexdigest()
+
+
+def make_key(*fields):
+    """Combine several fields into a single cache key."""
+
+    return hashlib.sha1('|'.join(str(field) for field in fields).encode()).hexdigest()
+
+
+class DiskCache(object):
+    """Directory of cache entries evicted by age and total size.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Top level cache directory.
+    subdir: str
+        Sub-directory of cache_dir holding this cache's entries.
+    max_age: float
+        Evict entries older than this many days. (Default=None, never)
+    max_size: float
+        Evict oldest entries once the cache exceeds this many MB.
+        (Default=None, unbounded)
+    """
+
+    def __init__(self, cache_dir, subdir, max_age=None, max_size=None):
+        self.cache_dir = os.path.join(cache_dir, subdir)
+        self.max_age = max_age
+        self.max_size = max_size
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _expired(self, path):
+        """Remove path if it is older than max_age, return True if removed."""
+
+        if self.max_age is not None:
+            if time.time() - os.path.getmtime(path) > self.max_age * 86400:
+                os.remove(path)
+                return True
+        return False
+
+    def evict(self):
+        """Remove entries older than max_age and, if the cache is larger than
+        max_size, the least recently written entries until it fits.
+        """
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        now = time.time()
+        if self.max_age is not None:
+            expired = [entry for entry in entries
+                       if now - entry[0] > self.max_age * 86400]
+            for entry in expired:
+                os.remove(entry[2])
+            entries = [entry for entry in entries if entry not in expired]
+
+        if self.max_size is not None:
+            entries.sort()
+            total = sum(entry[1] for entry in entries)
+            while entries and total > self.max_size * 2**20:
+                mtime, size, path = entries.pop(0)
+                os.remove(path)
+                total -= size
+
+
+class ResultCache(DiskCache):
+    """Cache of test results stored as one JSON file per key.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Directory to store results in.
+    max_age: float
+        Evict entries older than this many days. (Default=None, never)
+    max_size: float
+        Evict oldest entries once the cache exceeds this many MB.
+        (Default=None, unbounded)
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_age=None, max_size=None):
+        super(ResultCache, self).__init__(cache_dir, 'results',
+                                          max_age=max_age, max_size=max_size)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '{}.json'.format(key))
+
+    def get(self, key):
+        """Return the cached record for key or None."""
+
+        path = self._path(key)
+        if not os.path.exists(path) or self._expired(path):
+            return None
+
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except ValueError:
+            # Partially written or corrupt entry, treat as a miss.
+            return None
+
+    def put(self, key, record):
+        """Store record under key. The write goes through a temporary file so
+        concurrent workers never read half written entries.
+        """
+
+        path = self._path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f, default=str)
+        os.replace(tmp_path, path)
+
+
+class ProductCache(DiskCache):
+    """Content addressed cache of intermediate pipeline products, e.g. the
+    rate file Detector1Pipeline produces for a given uncal file.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Directory to store products in.
+    max_age: float
+        Evict entries older than this many days. (Default=None, never)
+    max_size: float
+        Evict oldest entries once the cache exceeds this many MB.
+        (Default=None, unbounded)
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_age=None, max_size=None):
+        super(ProductCache, self).__init__(cache_dir, 'products',
+                                           max_age=max_age, max_size=max_size)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '{}.fits'.format(key))
+
+    def get(self, key):
+        """Return the path to the cached product for key or None."""
+
+        path = self._path(key)
+        if not os.path.exists(path) or self._expired(path):
+            return None
+
+        return path
+
+    def put(self, key, model):
+        """Save a datamodel under key and return the cached path."""
+
+        path = self._path(key)
+        tmp_path = '{}.{}.tmp.fits'.format(path[:-len('.fits')], os.getpid())
+        model.save(tmp_path)
+        os.replace(tmp_path, path)
+
+        return path
+
+
+class StagingCache(DiskCache):
+    """Copies of input data sets on fast local storage, kept across runs and
+    evicted least recently used first.
+
+    Every copy lives in a directory named after the fingerprint of its
+    source, so a source that changed is staged afresh and a stale copy is
+    never used. The copy keeps the file name, size and modification time of
+    the source and therefore also its fingerprint.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Directory on local storage to stage files in.
+    max_size: float
+        Evict least recently used copies once the cache exceeds this many
+        MB. (Default=None, unbounded)
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        super(StagingCache, self).__init__(cache_dir, 'staged', max_size=max_size)
+        self.pinned = set()
+        self._lock = threading.Lock()
+
+    def stage(self, data_file):
+        """Copy data_file to local storage unless a current copy is there,
+        and return the path of the copy. The copy is pinned, and not
+        evicted, until release is called.
+        """
+
+        entry = os.path.join(self.cache_dir, file_fingerprint(data_file))
+        path = os.path.join(entry, os.path.basename(data_file))
+        with self._lock:
+            self.pinned.add(entry)
+
+        if os.path.exists(path):
+            # The directory's mtime is the last use.
+            os.utime(entry)
+            return path
+
+        os.makedirs(entry, exist_ok=True)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        shutil.copy2(data_file, tmp_path)
+        os.replace(tmp_path, path)
+        os.utime(entry)
+        self.evict()
+
+        return path
+
+    def release(self, data_file):
+        """Allow the copy of data_file to be evicted again."""
+
+        with self._lock:
+            self.pinned.discard(os.path.join(self.cache_dir, file_fingerprint(data_file)))
+
+    def evict(self):
+        """Remove the least recently used copies that are not pinned until
+        the cache is no larger than max_size.
+        """
+
+        if self.max_size is None:
+            return
+
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                entry = os.path.join(self.cache_dir, name)
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+
+            entries.sort()
+            total = sum(entry[1] for entry in entries)
+            for mtime, size, entry in entries:
+                if total <= self.max_size * 2**20:
+                    break
+                if entry not in self.pinned:
+                    shutil.rmtree(entry, ignore_errors=True)
+                    total -= size
@@ -0,0 +1,132 @@
+"""Running calibration tasks on a dask.distributed cluster.
+
+dask.distributed is only needed when a --scheduler is given, so it is
+imported on first use.
+"""
+
+import os
+import zlib
+
+from .scheduler import failed_record
+
+
+def _preload_jwst(dask_worker=None):
+    """Import the calibration pipelines once per worker, not once per task."""
+
+    import jwst.pipeline  # noqa: F401
+
+
+def get_client(scheduler, n_workers=None):
+    """Connect to a dask.distributed scheduler.
+
+    Parameters
+    ----------
+    scheduler: str
+        'local' to start a LocalCluster on this machine, the path of a
+        scheduler file written by dask-scheduler, or a scheduler address
+        such as tcp://10.0.0.1:8786.
+    n_workers: int
+        Number of single threaded worker processes for 'local'.
+
+    Returns
+    -------
+    client: distributed.Client
+        Client that also serves as the default dask scheduler.
+    """
+
+    from distributed import Client
+
+    if scheduler == 'local':
+        client = Client(n_workers=n_workers, threads_per_worker=1, processes=True)
+    elif os.path.isfile(scheduler):
+        client = Client(scheduler_file=scheduler)
+    else:
+        client = Client(scheduler)
+
+    client.register_worker_callbacks(setup=_preload_jwst)
+    print('Connected to dask scheduler {} with {} worker threads'.format(
+        client.scheduler.address, cluster_capacity(client)))
+
+    return client
+
+
+def cluster_capacity(client):
+    """Total number of worker threads on the cluster."""
+
+    return sum(worker['nthreads'] for worker in client.scheduler_info()['workers'].values())
+
+
+def locality_hint(data_file, workers):
+    """Preferred worker for a data file.
+
+    Data sets in the same directory go to the same worker, so its page cache
+    and local disk are reused. Other workers may still take the task.
+    """
+
+    if not workers:
+        return None
+
+    index = zlib.crc32(os.path.dirname(data_file).encode()) % len(workers)
+
+    return [workers[index]]
+
+
+def _run_task(function, args, task, kwargs):
+    """Worker side wrapper turning exceptions into result records."""
+
+    try:
+        return function(*(tuple(args) + (task['data_file'],)), **kwargs)
+    except Exception as err:
+        return failed_record(task, 'FAILED', str(err))
+
+
+def run_tasks_distributed(client, function, tasks, args=(), kwargs=None):
+    """Run function(*args, task['data_file'], **kwargs) for every task on a
+    dask.distributed cluster.
+
+    Every task is submitted up front with its 'estimate' as priority, so the
+    scheduler starts the longest tasks first, and a locality hint. If the
+    caller stops iterating the tasks still queued or running are cancelled.
+
+    Parameters
+    ----------
+    client: distributed.Client
+        Client from get_client.
+    function: func
+        Function returning a result record.
+    tasks: list
+        Tasks from make_task.
+    args: tuple
+        Positional arguments passed ahead of the data file.
+    kwargs: dict
+        Keyword arguments passed to function.
+
+    Yields
+    ------
+    task, result: dict, dict
+        Each task with its result record, in the order they complete.
+    """
+
+    from distributed import as_completed
+
+    kwargs = kwargs or {}
+    workers = sorted(client.scheduler_info()['workers'])
+    futures = {}
+    for task in tasks:
+        future = client.submit(_run_task, function, args, task, kwargs,
+                               priority=int(task.get('estimate', 0)), pure=False,
+                               workers=locality_hint(task['data_file'], workers),
+                               allow_other_workers=True)
+        futures[future] = task
+
+    try:
+        for future in as_completed(list(futures)):
+            task = futures.pop(future)
+            if future.status == 'error':
+                # e.g. the worker died, taking the task with it.
+                result = failed_record(task, 'FAILED', str(future.exception()))
+            else:
+                result = future.result()
+            yield task, result
+    finally:
+        client.cancel(list(futures))
@@ -2,11 +2,13 @@
 
 Usage:
   db_utils create <db_path>
-  db_utils (add | replace | force | full_reg_set | full_force) <db_path> <file_path> [--extension=<ext>] [--num_cpu=<n>] [--gen=<gn>]
+  db_utils (add | replace | force | full_reg_set | full_force) <db_path> <file_path> [--extension=<ext>] [--num_cpu=<n>] [--gen=<gn>] [--scheduler=<addr>]
+  db_utils derive-mini <db_path> <out_dir> [--ngroups=<n>] [--crop=<px>] [--num_cpu=<n>]
 
 Arguments:
   <db_path>     Absolute path to database.
   <file_path>   Absolute path to fits file to add.
+  <out_dir>     Directory to write mini data sets to.
 
 Options:
   -h --help         Show this screen.
@@ -14,8 +16,13 @@ Options:
   --num_cpu=<n>     number of cpus to use [default: 2]
   --extension=<ext>  extension [default: fits]
   --gen=<gn>       [default: 0]
+  --scheduler=<addr>  extract keywords on a dask.distributed cluster, given by
+                      its scheduler address, a scheduler file, or 'local'.
+  --ngroups=<n>     groups to keep in mini data sets [default: 5]
+  --crop=<px>       only keep this many pixels square of mini data sets.
 """
 
+import datetime
 import glob
 import os
 
@@ -26,10 +33,14 @@ from docopt import docopt
 import itertools
 import psutil
 import re
-from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy import Column, Float, ForeignKey, Integer, String, Text, create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from .cache import file_fingerprint
+from .cluster import get_client
+from .mini import derive_mini, mini_filename
+
 Base = declarative_base()
 
 class TestData(Base):
@@ -147,6 +158,131 @@ class RegressionData(Base):
         self.BKGDTARG = header.get('BKGDTARG')
         self.TSOVISIT = header.get('TSOVISIT')
 
+class TestRun(Base):
+    __tablename__ = 'test_runs'
+
+    run_id = Column(Integer, primary_key=True)
+    ref_file = Column(String(200))
+    started = Column(String(26))
+    jwst_version = Column(String(20))
+    crds_context = Column(String(30))
+
+
+class TestResult(Base):
+    __tablename__ = 'test_results'
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('test_runs.run_id'), index=True)
+    ref_file = Column(String(200))
+    path = Column(String(200))
+    filename = Column(String(100))
+    status = Column(String(10))
+    error = Column(Text)
+    duration = Column(Float)
+    peak_memory = Column(Float)
+    jwst_version = Column(String(20))
+    crds_context = Column(String(30))
+
+
+class MiniData(Base):
+    __tablename__ = 'mini_data'
+
+    filename = Column(String(100), primary_key=True)
+    path = Column(String(200))
+    parent_filename = Column(String(100), ForeignKey('regression_data.filename'), index=True)
+    parent_fingerprint = Column(String(40))
+    NINTS = Column(String(20))
+    NGROUPS = Column(String(20))
+    SUBSIZE1 = Column(String(20))
+    SUBSIZE2 = Column(String(20))
+
+
+class ResultDBWriter(object):
+    """Record a test run and its results in the test_runs and test_results
+    tables, committing results in batches.
+
+    Parameters
+    ----------
+    db_path: str
+        Absolute path to database.
+    ref_file: str
+        Reference file under test.
+    jwst_version: str
+        Version of the jwst package used.
+    crds_context: str
+        CRDS context used.
+    batch_size: int
+        Number of results to collect before each commit.
+    """
+
+    def __init__(self, db_path, ref_file, jwst_version, crds_context, batch_size=50):
+        self.session = load_session(db_path)
+        self.ref_file = ref_file
+        self.jwst_version = jwst_version
+        self.crds_context = crds_context
+        self.batch_size = batch_size
+        self._batch = []
+
+        # DBs made before these tables existed get them on first use.
+        Base.metadata.create_all(self.session.get_bind(),
+                                 tables=[TestRun.__table__, TestResult.__table__])
+
+        run = TestRun(ref_file=ref_file,
+                      started=datetime.datetime.now().isoformat(),
+                      jwst_version=jwst_version,
+                      crds_context=crds_context)
+        self.session.add(run)
+        self.session.commit()
+        self.run_id = run.run_id
+
+    def write(self, record):
+        error = record.get('Error_Msg')
+        self._batch.append(TestResult(run_id=self.run_id,
+                                      ref_file=self.ref_file,
+                                      path=record['Path'],
+                                      filename=record['Filename'],
+                                      status=record['Test_Status'],
+                                      error=str(error) if error is not None else None,
+                                      duration=record.get('Duration'),
+                                      peak_memory=record.get('Peak_RSS_MB'),
+                                      jwst_version=self.jwst_version,
+                                      crds_context=self.crds_context))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            self.session.add_all(self._batch)
+            self.session.commit()
+            self._batch = []
+
+    def close(self):
+        self.flush()
+        self.session.close()
+
+
+def failed_datasets(session, run_id):
+    """Find the data sets that did not pass in a recorded test run.
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.Session
+        DB Session
+    run_id: int
+        Run to look in.
+
+    Returns
+    -------
+    data_files: list
+        Absolute paths of the data sets.
+    """
+
+    query_result = session.query(TestResult).filter(TestResult.run_id == run_id,
+                                                    TestResult.status != 'PASSED')
+
+    return [os.path.join(result.path, result.filename) for result in query_result]
+
+
 def load_session(db_path=None):
     """
     Create a new session with the test data DB.
@@ -170,6 +306,196 @@ def load_session(db_path=None):
         return session
 
 
+def row_to_dict(row):
+    """Convert a DB row into a dictionary keyed by column name."""
+
+    return {column.name: getattr(row, column.name) for column in row.__table__.columns}
+
+
+def lookup_datasets(session, data_files, chunk_size=500):
+    """Find the regression_data rows for a list of data files.
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.Session
+        DB Session
+    data_files: list
+        Absolute paths to data files.
+    chunk_size: int
+        Number of filenames per query, keeps us below SQLite's limit on
+        query parameters.
+
+    Returns
+    -------
+    datasets: dict
+        Rows as dictionaries keyed by absolute path.
+    """
+
+    names = [os.path.basename(fname) for fname in data_files]
+    datasets = {}
+    for i in range(0, len(names), chunk_size):
+        query_result = session.query(RegressionData).filter(
+            RegressionData.filename.in_(names[i:i + chunk_size]))
+        for row in query_result:
+            datasets[os.path.join(row.path, row.filename)] = row_to_dict(row)
+
+    return datasets
+
+
+def lookup_minis(session, data_files, chunk_size=500):
+    """Find the mini data sets derived from a list of data files.
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.Session
+        DB Session
+    data_files: list
+        Absolute paths to data files.
+    chunk_size: int
+        Number of filenames per query.
+
+    Returns
+    -------
+    minis: dict
+        mini_data rows as dictionaries keyed by the absolute path of their
+        parent data file.
+    """
+
+    Base.metadata.create_all(session.get_bind(), tables=[MiniData.__table__])
+
+    paths = {os.path.basename(fname): fname for fname in data_files}
+    names = list(paths)
+    minis = {}
+    for i in range(0, len(names), chunk_size):
+        query_result = session.query(MiniData).filter(
+            MiniData.parent_filename.in_(names[i:i + chunk_size]))
+        for row in query_result:
+            minis[paths[row.parent_filename]] = row_to_dict(row)
+
+    return minis
+
+
+def parent_datasets(session, data_files, chunk_size=500):
+    """Replace the mini data sets in a list of data files by the data sets
+    they were derived from, e.g. for a run recorded with --mini.
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.Session
+        DB Session
+    data_files: list
+        Absolute paths to data files, full size or mini.
+    chunk_size: int
+        Number of filenames per query.
+
+    Returns
+    -------
+    data_files: list
+        Absolute paths of the full size data sets, in the same order and
+        without duplicates.
+    """
+
+    Base.metadata.create_all(session.get_bind(), tables=[MiniData.__table__])
+
+    names = list(set(os.path.basename(fname) for fname in data_files))
+    parents = {}
+    for i in range(0, len(names), chunk_size):
+        query_result = session.query(MiniData.filename, RegressionData.path,
+                                     RegressionData.filename).join(
+            RegressionData, MiniData.parent_filename == RegressionData.filename).filter(
+            MiniData.filename.in_(names[i:i + chunk_size]))
+        for mini_filename, path, filename in query_result:
+            parents[mini_filename] = os.path.join(path, filename)
+
+    seen = set()
+    result = []
+    for fname in data_files:
+        fname = parents.get(os.path.basename(fname), fname)
+        if fname not in seen:
+            seen.add(fname)
+            result.append(fname)
+
+    return result
+
+
+def _derive_mini(data_file, out_dir, ngroups, crop):
+    """Derive one mini data set, returning its mini_data row or None."""
+
+    try:
+        mini_file = derive_mini(data_file, out_dir, ngroups=ngroups, crop=crop)
+    except Exception as err:
+        print('Could not derive a mini copy of {}: {}'.format(data_file, err))
+        return None
+
+    header = fits.getheader(mini_file)
+    path, name = os.path.split(mini_file)
+
+    return MiniData(filename=name,
+                    path=path,
+                    parent_filename=os.path.basename(data_file),
+                    parent_fingerprint=file_fingerprint(data_file),
+                    NINTS=header.get('NINTS'),
+                    NGROUPS=header.get('NGROUPS'),
+                    SUBSIZE1=header.get('SUBSIZE1'),
+                    SUBSIZE2=header.get('SUBSIZE2'))
+
+
+def derive_minis(db_path, out_dir, ngroups=5, crop=None, num_cpu=2):
+    """Derive mini data sets from every regression_data row and register
+    them in the mini_data table. Data sets whose mini copy was made from
+    the current version of the file with the same settings are skipped.
+
+    Parameters
+    ----------
+    db_path: str
+        Absolute path to database.
+    out_dir: str
+        Directory to write mini data sets to.
+    ngroups: int
+        Maximum number of groups to keep.
+    crop: int
+        Size in pixels of the corner to keep. (Default=None, keep all)
+    num_cpu: int
+        Number of worker to pass dask.compute
+
+    Returns
+    -------
+    None
+    """
+
+    session = load_session(db_path)
+    os.makedirs(out_dir, exist_ok=True)
+
+    data_files = [os.path.join(row.path, row.filename)
+                  for row in session.query(RegressionData)]
+    minis = lookup_minis(session, data_files)
+
+    todo = []
+    for data_file in data_files:
+        mini = minis.get(data_file)
+        if (mini is not None and
+                mini['filename'] == mini_filename(data_file, ngroups, crop) and
+                os.path.exists(os.path.join(mini['path'], mini['filename'])) and
+                mini['parent_fingerprint'] == file_fingerprint(data_file)):
+            continue
+        todo.append(data_file)
+    print('DERIVING {} MINI DATA SETS ({} UP TO DATE)....'.format(
+        len(todo), len(data_files) - len(todo)))
+
+    with ProgressBar():
+        rows = compute([delayed(_derive_mini)(data_file, out_dir, ngroups, crop)
+                        for data_file in todo], num_workers=num_cpu)[0]
+
+    for data_file, row in zip(todo, rows):
+        if row is None:
+            continue
+        # A parent has one mini data set, the latest.
+        session.query(MiniData).filter(
+            MiniData.parent_filename == row.parent_filename).delete()
+        session.merge(row)
+    session.commit()
+
+
 def commit_session(data, db_path):
     """Load and commit additions to DB
 
@@ -446,7 +772,7 @@ def add_test_data(file_path, db_path=None, force=False, replace=False, full_forc
 
 
 
-def bulk_populate(force, file_path, db_path, num_cpu, extension, gen):
+def bulk_populate(force, file_path, db_path, num_cpu, extension, gen, scheduler=None):
     """Populate database in parallel.
 
     Parameters
@@ -459,12 +785,20 @@ def bulk_populate(force, file_path, db_path, num_cpu, extension, gen):
         Absolute pat to database
     num_cpu: int
         Number of worker to pass dask.compute
+    scheduler: str
+        dask.distributed scheduler address, scheduler file or 'local'.
+        (Default=None, local dask scheduler with num_cpu workers)
 
     Returns
     -------
     None
     """
 
+    # A connected client becomes the default scheduler of every compute below.
+    client = None
+    if scheduler is not None:
+        client = get_client(scheduler, n_workers=num_cpu)
+
     print("GATHERING DATA, THIS CAN TAKE A FEW MINUTES....")
 
     # Looks for all the files with the provided extension in the find_all_datasets function
@@ -480,7 +814,10 @@ def bulk_populate(force, file_path, db_path, num_cpu, extension, gen):
 
     print("EXTRACTING KEYWORDS....")
     with ProgressBar():
-        data_to_insert = compute(data, num_workers=num_cpu)[0]
+        if client is not None:
+            data_to_insert = compute(data)[0]
+        else:
+            data_to_insert = compute(data, num_workers=num_cpu)[0]
 
     print("INSERTING INTO DB....")
     data_to_ingest = []
@@ -490,6 +827,9 @@ def bulk_populate(force, file_path, db_path, num_cpu, extension, gen):
     #with ProgressBar():
     #    compute(data_to_ingest, num_workers=num_cpu)
 
+    if client is not None:
+        client.close()
+
     if not all_file_dirs:
         for file_path in full_file_paths:
             add_test_data(file_path, db_path, force=force, extension=extension)
@@ -547,14 +887,20 @@ def main():
     # Parse command line arguments
     if args['create']:
         create_test_data_db(args['<db_path>'])
+    elif args['derive-mini']:
+        derive_minis(args['<db_path>'], args['<out_dir>'],
+                     ngroups=int(args['--ngroups']),
+                     crop=int(args['--crop']) if args['--crop'] else None,
+                     num_cpu=int(args['--num_cpu']))
     elif args['add'] or args['force'] or args['replace']:
         add_test_data(args['<file_path>'],
                       db_path=args['<db_path>'],
                       force=args['force'],
                       replace=args['replace'])
     elif args['full_reg_set'] or args['full_force']:
-        # Check to make sure user isn't exceeding number of CPUs.
-        if int(args['--num_cpu']) > psutil.cpu_count():
+        # Check to make sure user isn't exceeding number of CPUs, a cluster
+        # brings its own.
+        if args['--scheduler'] is None and int(args['--num_cpu']) > psutil.cpu_count():
                 args = (psutil.cpu_count(), args['--num_cpu'])
                 err_str = "YOUR MACHINE ONLY HAS {} CPUs! YOU ENTERED {}"
                 raise ValueError(err_str.format(*args))
@@ -565,10 +911,12 @@ def main():
                           args['<db_path>'],
                           int(args['--num_cpu']),
                           args['--extension'],
-                          int(args['--gen']))
+                          int(args['--gen']),
+                          scheduler=args['--scheduler'])
             else:
                bulk_populate(False,args['<file_path>'],
                           args['<db_path>'],
                           int(args['--num_cpu']),
                           args['--extension'],
-                          int(args['--gen']))
+                          int(args['--gen']),
+                          scheduler=args['--scheduler'])
@@ -0,0 +1,559 @@
+"""Vectorized CRDS reference file selection over the regression database.
+
+CRDS mappings are read straight from the local CRDS cache, so nothing here
+needs to talk to a CRDS server.
+"""
+
+import ast
+import os
+
+import crds
+import numpy as np
+import pandas as pd
+
+from . import db
+
+
+# CRDS matching parameters and the regression_data columns holding them.
+META_TO_COLUMN = {
+    'META.INSTRUMENT.NAME': 'INSTRUME',
+    'META.EXPOSURE.READPATT': 'READPATT',
+    'META.EXPOSURE.TYPE': 'EXP_TYPE',
+    'META.EXPOSURE.NINTS': 'NINTS',
+    'META.EXPOSURE.NGROUPS': 'NGROUPS',
+    'META.INSTRUMENT.BAND': 'BAND',
+    'META.INSTRUMENT.CHANNEL': 'CHANNEL',
+    'META.INSTRUMENT.CORONAGRAPH': 'CORONMSK',
+    'META.INSTRUMENT.DETECTOR': 'DETECTOR',
+    'META.INSTRUMENT.FILTER': 'FILTER',
+    'META.INSTRUMENT.GRATING': 'GRATING',
+    'META.INSTRUMENT.PUPIL': 'PUPIL',
+    'META.OBSERVATION.TEMPLATE': 'TEMPLATE',
+    'META.OBSERVATION.BKGDTARG': 'BKGDTARG',
+    'META.VISIT.TSOVISIT': 'TSOVISIT',
+    'META.SUBARRAY.NAME': 'SUBARRAY',
+    'META.SUBARRAY.XSTART': 'SUBSTRT1',
+    'META.SUBARRAY.YSTART': 'SUBSTRT2',
+    'META.SUBARRAY.XSIZE': 'SUBSIZE1',
+    'META.SUBARRAY.YSIZE': 'SUBSIZE2',
+}
+
+# Patterns that match any value and don't add to a rule's weight.
+WILDCARDS = ('*', 'ANY', 'N/A', 'GENERIC')
+
+# Value CRDS uses for keywords missing from a data set.
+UNDEFINED = 'UNDEFINED'
+
+# Boolean matching parameters. CRDS matches them as 'T'/'F', SQLite hands
+# them back as '1'/'0' and reference files may hold True/'TRUE'.
+BOOLEAN_PARAMS = ('META.VISIT.TSOVISIT', 'META.OBSERVATION.BKGDTARG')
+CRDS_BOOLEANS = {'T': 'T', 'TRUE': 'T', '1': 'T', 'F': 'F', 'FALSE': 'F', '0': 'F'}
+
+# pandas >= 2 infers one date format for a whole column unless told not to.
+PANDAS_MIXED_DATES = int(pd.__version__.split('.')[0]) >= 2
+
+
+def locate_mapping(name):
+    """Path of a CRDS mapping in the local CRDS cache."""
+
+    return crds.config.locate_mapping(name, 'jwst')
+
+
+def locate_reference(name):
+    """Path of a reference file in the local CRDS cache."""
+
+    return crds.config.locate_file(name, 'jwst')
+
+
+def sync_references(names, context):
+    """Make sure reference files are in the local CRDS cache. Only the files
+    that are missing are fetched, so with a fully populated cache no CRDS
+    server is contacted.
+
+    Parameters
+    ----------
+    names: list
+        Reference file names.
+    context: str
+        Context the files belong to.
+
+    Returns
+    -------
+    paths: dict
+        Local path of every reference file keyed by name.
+    """
+
+    paths = {name: locate_reference(name) for name in names}
+    missing = sorted(name for name, path in paths.items() if not os.path.exists(path))
+    if missing:
+        print('Fetching {} reference files into the CRDS cache'.format(len(missing)))
+        crds.api.dump_references(context, baserefs=missing)
+
+    return paths
+
+
+def mapping_selections(name):
+    """Selections of a pmap or imap as a dictionary with upper case keys."""
+
+    header, selector = read_mapping(locate_mapping(name))
+
+    return {key.upper(): value for key, value in selector}
+
+
+def get_rmap_name(context, instrument, reftype):
+    """Name of the rmap a context uses for an instrument and reference type,
+    or None if the reference type doesn't apply.
+    """
+
+    imap = mapping_selections(context).get(instrument.upper())
+    if imap is None or imap == 'N/A':
+        return None
+
+    rmap = mapping_selections(imap).get(reftype.upper())
+    if rmap is None or rmap == 'N/A':
+        return None
+
+    return rmap
+
+
+def _convert(node):
+    """Turn a node of a parsed mapping into plain data. Dictionaries become
+    lists of (key, value) pairs to keep rule order, selector calls such as
+    Match({...}) become (name, pairs) tuples.
+    """
+
+    if isinstance(node, ast.Call):
+        return (node.func.id, _convert(node.args[0]))
+    if isinstance(node, ast.Dict):
+        return [(_convert(key), _convert(value))
+                for key, value in zip(node.keys, node.values)]
+
+    return ast.literal_eval(node)
+
+
+def read_mapping(filename):
+    """Parse a CRDS mapping file (pmap, imap or rmap).
+
+    Parameters
+    ----------
+    filename: str
+        Path to the mapping.
+
+    Returns
+    -------
+    header: dict
+        Mapping header.
+    selector: list or tuple
+        For pmaps and imaps a list of (key, mapping name) pairs, for rmaps a
+        ('Match' or 'UseAfter', pairs) tuple.
+    """
+
+    with open(filename) as f:
+        tree = ast.parse(f.read(), filename=filename)
+
+    values = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            values[node.targets[0].id] = _convert(node.value)
+
+    return dict(values['header']), values['selector']
+
+
+def selection_table(header, selector):
+    """Flatten an rmap into a table of rules.
+
+    Parameters
+    ----------
+    header: dict
+        rmap header from read_mapping.
+    selector: tuple
+        rmap selector from read_mapping.
+
+    Returns
+    -------
+    params: tuple
+        Names of the matching parameters.
+    entries: list
+        One (patterns, useafter, reference) tuple per rule, useafter is None
+        for rules without a date.
+    """
+
+    kind, choices = selector
+    entries = []
+
+    if kind == 'UseAfter':
+        params = ()
+        for useafter, reference in choices:
+            entries.append(((), useafter, reference))
+
+    elif kind == 'Match':
+        params = tuple(header['parkey'][0])
+        for key, value in choices:
+            key = key if isinstance(key, tuple) else (key,)
+            if isinstance(value, tuple) and value[0] == 'UseAfter':
+                for useafter, reference in value[1]:
+                    entries.append((key, useafter, reference))
+            elif isinstance(value, str):
+                entries.append((key, None, value))
+            else:
+                raise ValueError('Unsupported nested selector in {}: {}'.format(
+                    header.get('name'), value[0]))
+    else:
+        raise ValueError('Unsupported selector {} in {}'.format(kind, header.get('name')))
+
+    return params, entries
+
+
+def header_conditions(header):
+    """rmap header entries that make CRDS's choice depend on more than the
+    match rules, e.g. rmap_relevance or substitutions.
+
+    Parameters
+    ----------
+    header: dict
+        rmap header from read_mapping.
+
+    Returns
+    -------
+    conditions: list
+        Names of the entries, empty if the rules alone decide.
+    """
+
+    conditions = []
+    if str(header.get('rmap_relevance', 'always')).strip() not in ('always', 'True'):
+        conditions.append('rmap_relevance')
+    if str(header.get('rmap_omit', 'False')).strip() != 'False':
+        conditions.append('rmap_omit')
+    if str(header.get('reffile_switch', 'NONE')).strip().upper() != 'NONE':
+        conditions.append('reffile_switch')
+    for name in ('substitutions', 'hooks'):
+        if header.get(name):
+            conditions.append(name)
+
+    return conditions
+
+
+def load_regression_frame(session, instrument=None):
+    """Load the regression_data table into a DataFrame.
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.Session
+        DB Session
+    instrument: str
+        Only load data sets of this instrument. (Default=None, all)
+
+    Returns
+    -------
+    frame: pandas.DataFrame
+        One row per data set.
+    """
+
+    query = session.query(db.RegressionData)
+    if instrument is not None:
+        query = query.filter(db.RegressionData.INSTRUME == instrument.upper())
+
+    return pd.read_sql(query.statement, session.bind)
+
+
+def crds_bool(value):
+    """Spell a boolean the way CRDS matches it, 'T' or 'F'. Anything else,
+    e.g. a wildcard or UNDEFINED, is returned upper cased.
+    """
+
+    value = str(value).strip().upper()
+
+    return CRDS_BOOLEANS.get(value, value)
+
+
+def _bool_pattern(pattern):
+    """crds_bool for every option of an 'A|B|' style pattern."""
+
+    pattern = str(pattern).strip()
+    if pattern.startswith('^'):
+        return pattern
+
+    return '|'.join(crds_bool(option) if option.strip() else option
+                    for option in pattern.split('|'))
+
+
+def pattern_mask(pattern, values):
+    """Evaluate one CRDS match pattern against a column of values.
+
+    Parameters
+    ----------
+    pattern: str
+        Literal value, 'A|B|' style OR pattern, regular expression starting
+        with '^' or one of WILDCARDS.
+    values: numpy.ndarray
+        Upper case string values of the data sets, None if the column is not
+        in the database.
+
+    Returns
+    -------
+    mask, weight: numpy.ndarray or None, int
+        Which data sets match (None for all) and 1 if the pattern counts
+        towards the specificity of the rule, else 0.
+    """
+
+    pattern = str(pattern).strip().upper()
+    if pattern in WILDCARDS or values is None:
+        return None, 0
+
+    if pattern.startswith('^'):
+        return pd.Series(values).str.match(pattern).values, 1
+
+    options = [option.strip() for option in pattern.split('|') if option.strip()]
+
+    return np.isin(values, options), 1
+
+
+def parse_dates(values):
+    """Parse dates and times, e.g. useafter dates or DATE_OBS + TIME_OBS.
+
+    Every value is parsed on its own terms, so rmap useafters
+    ('2016-01-01 00:00:00'), ISO dates with a 'T' and times with or without
+    fractional seconds can be mixed. pandas >= 2 would otherwise guess a
+    single format from the first value and turn the rest into NaT.
+
+    Parameters
+    ----------
+    values: list or pandas.Series
+        Date strings, None or unparseable values become NaT.
+
+    Returns
+    -------
+    dates: pandas.Series
+        datetime64 values.
+    """
+
+    values = pd.Series(values, dtype=object).fillna('').astype(str)
+    values = values.str.strip().str.replace('T', ' ', regex=False)
+    if PANDAS_MIXED_DATES:
+        return pd.to_datetime(values, errors='coerce', format='mixed')
+
+    return pd.to_datetime(values, errors='coerce')
+
+
+def best_references(params, entries, frame):
+    """Pick the best reference of an rmap for every data set at once.
+
+    As in CRDS, among the rules whose patterns match and whose useafter date
+    is not after the observation, the one matching the most parameters
+    exactly wins, with ties going to the latest useafter date and then to
+    the rule listed first.
+
+    Parameters
+    ----------
+    params: tuple
+        Matching parameters from selection_table.
+    entries: list
+        Rules from selection_table.
+    frame: pandas.DataFrame
+        Data sets from load_regression_frame.
+
+    Returns
+    -------
+    bestrefs: pandas.Series
+        Reference file name for each data set, None where no rule applies.
+    """
+
+    values = {}
+    for param in params:
+        column = META_TO_COLUMN.get(param)
+        if column is None or column not in frame:
+            print('WARNING: {} is not in the database, treating it as a wildcard'.format(param))
+            values[param] = None
+        else:
+            values[param] = frame[column].fillna(UNDEFINED).astype(str).str.strip().str.upper().values
+            if param in BOOLEAN_PARAMS:
+                values[param] = np.array([crds_bool(value) for value in values[param]],
+                                         dtype=object)
+
+    dates = parse_dates(frame['DATE_OBS'].fillna('') + ' ' + frame['TIME_OBS'].fillna('')).values
+    useafters = parse_dates([entry[1] for entry in entries])
+    # Dense rank of the useafter dates, rules without a date rank lowest.
+    ranks = useafters.rank(method='dense').fillna(0).astype(int).values
+
+    n_rows = len(frame)
+    best_score = np.full(n_rows, -1, dtype=np.int64)
+    best_entry = np.zeros(n_rows, dtype=np.int64)
+    masks = {}
+
+    for i, (key, useafter, reference) in enumerate(entries):
+        if key not in masks:
+            mask = np.ones(n_rows, dtype=bool)
+            weight = 0
+            for param, pattern in zip(params, key):
+                if param in BOOLEAN_PARAMS:
+                    pattern = _bool_pattern(pattern)
+                param_mask, param_weight = pattern_mask(pattern, values[param])
+                if param_mask is not None:
+                    mask &= param_mask
+                weight += param_weight
+            masks[key] = (mask, weight)
+        mask, weight = masks[key]
+
+        if pd.isnull(useafters[i]):
+            applicable = mask
+        else:
+            applicable = mask & (dates >= useafters[i].to_datetime64())
+
+        score = np.where(applicable, weight * (len(entries) + 1) + ranks[i], -1)
+        better = score > best_score
+        best_score[better] = score[better]
+        best_entry[better] = i
+
+    if not entries:
+        return pd.Series([None] * n_rows, index=frame.index, dtype=object)
+
+    references = np.array([entry[2] for entry in entries], dtype=object)
+
+    return pd.Series(np.where(best_score >= 0, references[best_entry], None),
+                     index=frame.index, dtype=object)
+
+
+def context_rmaps(context):
+    """All rmaps of a context.
+
+    Parameters
+    ----------
+    context: str
+        Name of a pmap, e.g. jwst_0500.pmap.
+
+    Returns
+    -------
+    rmaps: dict
+        rmap name keyed by (instrument, reftype), both upper case.
+    """
+
+    rmaps = {}
+    for instrument, imap in mapping_selections(context).items():
+        if imap == 'N/A':
+            continue
+        for reftype, rmap in mapping_selections(imap).items():
+            if rmap != 'N/A':
+                rmaps[(instrument, reftype)] = rmap
+
+    return rmaps
+
+
+def rmap_references(rmap, frame):
+    """Best reference of an rmap for every data set in frame, or all None
+    if the context has no rmap for it.
+    """
+
+    if rmap is None:
+        return pd.Series([None] * len(frame), index=frame.index, dtype=object)
+
+    params, entries = selection_table(*read_mapping(locate_mapping(rmap)))
+
+    return best_references(params, entries, frame)
+
+
+def context_impact(old_context, new_context, session):
+    """Find every data set whose best reference changes between two contexts.
+
+    Only the rmaps that differ between the contexts are evaluated, each over
+    all data sets of its instrument at once.
+
+    Parameters
+    ----------
+    old_context: str
+        Name of the current pmap.
+    new_context: str
+        Name of the pmap to be delivered.
+    session: sqlalchemy.orm.Session
+        DB Session
+
+    Returns
+    -------
+    records: list
+        One dictionary per affected (data set, reftype) with the Path,
+        Filename, Instrument, Reftype and the Old_Reference and New_Reference.
+    """
+
+    old_rmaps = context_rmaps(old_context)
+    new_rmaps = context_rmaps(new_context)
+    changed = sorted(key for key in set(old_rmaps) | set(new_rmaps)
+                     if old_rmaps.get(key) != new_rmaps.get(key))
+    print('{} rmaps differ between {} and {}'.format(len(changed), old_context, new_context))
+
+    records = []
+    frames = {}
+    for instrument, reftype in changed:
+        if instrument not in frames:
+            frames[instrument] = load_regression_frame(session, instrument=instrument)
+        frame = frames[instrument]
+        if frame.empty:
+            continue
+
+        old = rmap_references(old_rmaps.get((instrument, reftype)), frame)
+        new = rmap_references(new_rmaps.get((instrument, reftype)), frame)
+        affected = (old.fillna('N/A') != new.fillna('N/A')).values
+        print('\t{} {}: {} -> {}, {} data sets affected'.format(
+            instrument, reftype, old_rmaps.get((instrument, reftype)),
+            new_rmaps.get((instrument, reftype)), affected.sum()))
+
+        for path, filename, old_ref, new_ref in zip(frame['path'][affected],
+                                                    frame['filename'][affected],
+                                                    old[affected], new[affected]):
+            records.append({'Path': path,
+                            'Filename': filename,
+                            'Instrument': instrument,
+                            'Reftype': reftype,
+                            'Old_Reference': old_ref,
+                            'New_Reference': new_ref})
+
+    return records
+
+
+def resolve_references(datasets, context, reftypes):
+    """Best references of many data sets for many reference types in one
+    pass over the rmaps of a context.
+
+    Reference types whose rmap selects on parameters that are not in the
+    database, uses selectors this module doesn't evaluate or has header
+    conditions (see header_conditions) are left out so CRDS resolves them
+    as usual, e.g. to N/A for a step it should skip.
+
+    Parameters
+    ----------
+    datasets: dict
+        regression_data rows as dictionaries keyed by data file.
+    context: str
+        Name of the pmap to use.
+    reftypes: iterable
+        Reference types to resolve, e.g. 'dark'.
+
+    Returns
+    -------
+    bestrefs: dict
+        For every data file a dictionary of reference file names keyed by
+        reference type.
+    """
+
+    frame = pd.DataFrame(list(datasets.values()), index=list(datasets.keys()))
+    rmaps = context_rmaps(context)
+    bestrefs = {data_file: {} for data_file in datasets}
+
+    for instrument, group in frame.groupby(frame['INSTRUME'].str.upper()):
+        for reftype in reftypes:
+            rmap = rmaps.get((instrument, reftype.upper()))
+            if rmap is None:
+                continue
+            header, selector = read_mapping(locate_mapping(rmap))
+            if header_conditions(header):
+                continue
+            try:
+                params, entries = selection_table(header, selector)
+            except ValueError:
+                continue
+            if any(META_TO_COLUMN.get(param) not in group for param in params):
+                continue
+
+            for data_file, reference in best_references(params, entries, group).items():
+                if pd.notnull(reference):
+                    bestrefs[data_file][reftype] = reference
+
+    return bestrefs
@@ -0,0 +1,102 @@
+"""Reduced "mini" copies of uncal data sets for quick smoke tests."""
+
+import os
+
+from astropy.io import fits
+import numpy as np
+
+
+def mini_filename(data_file, ngroups, crop=None):
+    """Name of the mini copy of a data file, e.g. jw..._nrca1_mini5g_uncal.fits."""
+
+    root, ext = os.path.splitext(os.path.basename(data_file))
+    tag = 'mini{}g'.format(ngroups) if crop is None else 'mini{}g{}px'.format(ngroups, crop)
+    if root.endswith('_uncal'):
+        return '{}_{}_uncal{}'.format(root[:-len('_uncal')], tag, ext)
+
+    return '{}_{}{}'.format(root, tag, ext)
+
+
+def derive_mini(data_file, out_dir, ngroups=5, crop=None):
+    """Write a reduced copy of an uncal file: the first integration, at most
+    ngroups groups and optionally only the crop x crop pixels in the corner
+    at SUBSTRT1, SUBSTRT2.
+
+    Image extensions whose last two axes don't match SCI, e.g. MIRI REFOUT,
+    are dropped when cropping. The primary header keywords describing the
+    ramp and subarray are updated to match.
+
+    Parameters
+    ----------
+    data_file: str
+        Path to uncal file.
+    out_dir: str
+        Directory to write the copy to.
+    ngroups: int
+        Maximum number of groups to keep. (Default=5)
+    crop: int
+        Size in pixels of the corner to keep. (Default=None, keep all)
+
+    Returns
+    -------
+    mini_file: str
+        Path to the copy.
+    """
+
+    mini_file = os.path.join(out_dir, mini_filename(data_file, ngroups, crop))
+
+    with fits.open(data_file) as hdulist:
+        sci_shape = hdulist['SCI'].data.shape
+        ngroups = min(ngroups, sci_shape[1])
+        ny = sci_shape[2] if crop is None else min(crop, sci_shape[2])
+        nx = sci_shape[3] if crop is None else min(crop, sci_shape[3])
+
+        hdus = []
+        for hdu in hdulist:
+            if isinstance(hdu, fits.BinTableHDU):
+                data = hdu.data
+                names = [name.lower() for name in data.names]
+                # Keep the rows of the groups and integrations that are left.
+                if 'integration_number' in names:
+                    keep = data['integration_number'] == 1
+                    if 'group_number' in names:
+                        keep &= data['group_number'] <= ngroups
+                    data = data[keep]
+                hdus.append(fits.BinTableHDU(data=data, header=hdu.header, name=hdu.name))
+                continue
+
+            data = hdu.data
+            if data is not None:
+                if crop is not None and data.ndim >= 2 and data.shape[-2:] != sci_shape[-2:]:
+                    print('Dropping {} from {}, it cannot be cropped'.format(hdu.name, data_file))
+                    continue
+                if data.ndim == 4:
+                    data = data[:1, :ngroups]
+                elif data.ndim == 3 and data.shape[0] == sci_shape[0]:
+                    # e.g. ZEROFRAME, one plane per integration
+                    data = data[:1]
+                if data.ndim >= 2:
+                    data = data[..., :ny, :nx]
+                data = np.ascontiguousarray(data)
+
+            if isinstance(hdu, fits.PrimaryHDU):
+                hdus.append(fits.PrimaryHDU(data=data, header=hdu.header))
+            else:
+                hdus.append(fits.ImageHDU(data=data, header=hdu.header, name=hdu.name))
+
+        header = hdus[0].header
+        header['NINTS'] = 1
+        header['NGROUPS'] = ngroups
+        for keyword in ('INTSTART', 'INTEND'):
+            if keyword in header:
+                header[keyword] = 1
+        if crop is not None:
+            header['SUBSIZE1'] = nx
+            header['SUBSIZE2'] = ny
+            header['SUBARRAY'] = 'GENERIC'
+        header['HISTORY'] = 'Mini copy of {} made by db_utils derive-mini'.format(
+            os.path.basename(data_file))
+
+        fits.HDUList(hdus).writeto(mini_file, overwrite=True)
+
+    return mini_file
@@ -1,10 +1,15 @@
 """Script for testing reference files
 
 Usage:
-  test_ref_file <ref_file> <db_path> [--data=<fname>] [--max_matches=<match>] [--num_cpu=<n>] [--email=<addr>]
-  
+  test_ref_file merge <result_file>... [--output=<file>] [--email=<addr>]
+  test_ref_file <ref_file> <db_path> [--data=<fname>] [--max_matches=<match>] [--num_cpu=<n>] [--email=<addr>] [--no-cache] [--cache_dir=<dir>] [--cache_max_age=<days>] [--cache_max_size=<mb>] [--mode=<mode>] [--save_intermediate] [--discard-outputs] [--scratch_dir=<dir>] [--max_memory=<gb>] [--timeout=<min>] [--max_rss=<gb>] [--output=<file>] [--rerun-failed=<run_id>] [--sample=<strategy>] [--adaptive] [--fail_fast=<n>] [--passes_per_mode=<k>] [--plan] [--scheduler=<addr>] [--shard=<i/n>] [--prewarm] [--stage_dir=<dir>] [--stage_max_size=<gb>] [--prefetch=<k>] [--mmap] [--mini] [--stats] [--max_nan=<frac>] [--compare]
+  test_ref_file impact <old_context> <new_context> <db_path> [--output=<file>]
+
 Arguments:
   <db_path>     Absolute path to database. 
+  <old_context> CRDS context (pmap) in use, e.g. jwst_0500.pmap.
+  <new_context> CRDS context (pmap) to be delivered.
+  <result_file> Result file written with --output, e.g. by one --shard.
   <file_path>   Absolute path to fits file to add. 
 
 Options:
@@ -14,34 +19,85 @@ Options:
   --max_matches=<match>      maximum number of data sets to test
   --num_cpu=<n>              number of cores to use [default: 2]
   --email=<addr>             email results from job with html table.
+  --no-cache                 ignore cached results and recalibrate every data set.
+  --cache_dir=<dir>          directory for cached results [default: ~/.reftest_cache]
+  --cache_max_age=<days>     evict cached results older than this many days.
+  --cache_max_size=<mb>      evict oldest cached results beyond this size in MB.
+  --mode=<mode>              'full' runs every pipeline, 'step' stops after the
+                             last step that reads the reference file [default: full]
+  --save_intermediate        save products of every pipeline, not just the last.
+  --discard-outputs          turn off product saving for every step.
+  --scratch_dir=<dir>        run each task in its own directory under <dir>,
+                             removed when the task finishes.
+  --max_memory=<gb>          memory the workers may use in total, defaults to
+                             what is available.
+  --timeout=<min>            kill a task and record it as TIMEOUT after this
+                             many minutes.
+  --max_rss=<gb>             kill a task and record it as OOM when its resident
+                             memory exceeds this many GB.
+  --output=<file>            stream results to a .jsonl or .csv file as they
+                             finish, for impact the CSV file of affected data
+                             sets, for merge the combined results.
+  --rerun-failed=<run_id>    only rerun the data sets that did not pass in a
+                             recorded run.
+  --sample=<strategy>        how to pick --max_matches data sets, 'first' or
+                             'coverage' of observing modes [default: first]
+  --adaptive                 run data sets in waves across observing modes and
+                             stop early once the outcome is clear.
+  --fail_fast=<n>            with --adaptive, stop after n failures with the
+                             same error [default: 5]
+  --passes_per_mode=<k>      with --adaptive, stop once every observing mode
+                             passed k times.
+  --plan                     print the data sets, pipelines and estimated
+                             CPU time, memory and output size, then exit
+                             without calibrating.
+  --scheduler=<addr>         run on a dask.distributed cluster, given by its
+                             scheduler address, a scheduler file, or 'local'
+                             for a LocalCluster with --num_cpu workers.
+  --shard=<i/n>              only test shard i (0 to n-1) of n cost balanced
+                             shards of the matched data sets.
+  --prewarm                  resolve and fetch every other reference file the
+                             data sets need before starting the workers.
+  --stage_dir=<dir>          copy input data sets to this local directory
+                             ahead of the workers and keep them across runs.
+  --stage_max_size=<gb>      evict least recently used staged data sets beyond
+                             this size in GB [default: 100]
+  --prefetch=<k>             number of data sets to stage ahead [default: 2]
+  --mmap                     open the data sets memory mapped, so workers share
+                             unmodified pages through the page cache.
+  --mini                     test the mini copies made by db_utils derive-mini
+                             instead of the full data sets.
+  --stats                    add NaN/inf fractions, DQ flag counts and clipped
+                             statistics of every product array to the results.
+  --max_nan=<frac>           with --stats, report a product whose data is more
+                             than this fraction NaN or inf as SUSPECT.
+  --compare                  diff every product against a baseline made with
+                             the current CRDS reference file.
 """
 
 from __future__ import print_function
 
 import os
+import resource
+import shutil
+import tempfile
+import time
 
 from astropy.io import fits
 import crds
-from dask import compute, delayed
-from dask.diagnostics import ProgressBar
+from dask import delayed
 from docopt import docopt
 from email.headerregistry import Address
 from email.message import EmailMessage
 from email.mime.text import MIMEText
+import jwst
 from jwst import datamodels
-from jwst.pipeline import calwebb_dark, calwebb_image2, calwebb_spec2
-
-try:
-    from jwst.pipeline import SloperPipeline as Detector1Pipeline
-except ImportError:
-    from jwst.pipeline import Detector1Pipeline
 
 import logging
 import numpy as np
 import pandas as pd
 import psutil
 import smtplib
-from sqlalchemy import or_
 
 # Remove python 2 dependencies in the future..
 try:
@@ -50,6 +106,19 @@ except ImportError:
     from io import StringIO
 
 from . import db
+from .matching import (best_references, context_impact, get_rmap_name,
+                       load_regression_frame, locate_mapping, read_mapping,
+                       resolve_references, selection_table, sync_references)
+from .cluster import cluster_capacity, get_client, run_tasks_distributed
+from .cache import (ProductCache, ResultCache, StagingCache, file_checksum,
+                    file_fingerprint, make_key)
+from .results import (ResultWriter, format_step_summary, merge_results,
+                      read_results, report_records, summarize_steps)
+from .sampling import EarlyStopper, order_in_waves, sample_coverage
+from .stats import bad_fraction, compare_products, product_stats
+from .scheduler import (RuntimeHistory, estimate_makespan, make_task, order_tasks,
+                        output_bytes, parse_shard, run_tasks, shard_tasks,
+                        suggest_num_workers)
 
 p_mapping = {
     "META.EXPOSURE.TYPE": "META.EXPOSURE.P_EXPTYPE",
@@ -65,19 +134,6 @@ p_mapping = {
 }
 
 
-meta_to_fits = {
-    'META.INSTRUMENT.NAME': 'INSTRUME',
-    'META.EXPOSURE.READPATT': 'READPATT',
-    'META.EXPOSURE.TYPE': 'EXP_TYPE',
-    'META.INSTRUMENT.BAND': 'BAND',
-    'META.INSTRUMENT.CHANNEL': 'CHANNEL',
-    'META.INSTRUMENT.DETECTOR': 'DETECTOR',
-    'META.INSTRUMENT.FILTER': 'FILTER',
-    'META.INSTRUMENT.GRATING': 'GRATING',
-    'META.SUBARRAY.NAME': 'SUBARRAY'
-}
-
-
 IMAGING = ['fgs_image', 'fgs_focus', 'fgs_skyflat', 'fgs_intflat', 'mir_image',
            'mir_tacq', 'mir_lyot', 'mir_4qpm', 'mir_coroncal', 'nrc_image',
            'nrc_tacq', 'nrc_coron', 'nrc_taconfirm', 'nrc_focus', 'nrc_tsimage',
@@ -86,6 +142,37 @@ IMAGING = ['fgs_image', 'fgs_focus', 'fgs_skyflat', 'fgs_intflat', 'mir_image',
            'nrs_focus', 'nrs_mimf', 'nrs_bota']
 
 
+# Pipelines get_pipelines returns for each pipeline type.
+PIPELINE_NAMES = {'dark': ['DarkPipeline'],
+                  'detector1': ['Detector1Pipeline'],
+                  'image': ['Detector1Pipeline', 'Image2Pipeline'],
+                  'spec': ['Detector1Pipeline', 'Spec2Pipeline']}
+
+
+def get_pipeline_type(exp_type):
+    """Sorts which kind of processing an exp_type gets
+
+    Parameters
+    ----------
+    exp_type: str
+        JWST exposure type
+
+    Returns
+    -------
+    pipeline_type: str
+        One of 'dark', 'detector1', 'image' or 'spec'.
+    """
+
+    if 'DARK' in exp_type:
+        return 'dark'
+    elif 'FLAT' in exp_type:
+        return 'detector1'
+    elif exp_type.lower() in IMAGING:
+        return 'image'
+    else:
+        return 'spec'
+
+
 def get_pipelines(exp_type):
     """Sorts which pipeline to use based on exp_type
 
@@ -100,11 +187,20 @@ def get_pipelines(exp_type):
         Pipeline(s) to return for calibrating files.
     """
 
-    if 'DARK' in exp_type:
+    # Imported here so planning a run doesn't pay for loading every step.
+    from jwst.pipeline import calwebb_dark, calwebb_image2, calwebb_spec2
+    try:
+        from jwst.pipeline import SloperPipeline as Detector1Pipeline
+    except ImportError:
+        from jwst.pipeline import Detector1Pipeline
+
+    pipeline_type = get_pipeline_type(exp_type)
+
+    if pipeline_type == 'dark':
         pipeline = [calwebb_dark.DarkPipeline()]
-    elif 'FLAT' in exp_type:
+    elif pipeline_type == 'detector1':
         pipeline = [Detector1Pipeline()]
-    elif exp_type.lower() in IMAGING:
+    elif pipeline_type == 'image':
         pipeline = [Detector1Pipeline(), calwebb_image2.Image2Pipeline()]
     else:
         pipeline = [Detector1Pipeline(), calwebb_spec2.Spec2Pipeline()]
@@ -112,18 +208,458 @@ def get_pipelines(exp_type):
     return pipeline
 
 
+def consuming_steps(pipeline, reftype):
+    """Find the steps of a pipeline that read a reference file type.
+
+    Parameters
+    ----------
+    pipeline: jwst.stpipe.Pipeline
+        Pipeline to search.
+    reftype: str
+        CRDS reference file type, e.g. 'flat'.
+
+    Returns
+    -------
+    steps: list
+        Names of the steps with an override_<reftype> option.
+    """
+
+    return [step for step in pipeline.step_defs.keys()
+            if hasattr(getattr(pipeline, step), 'override_{}'.format(reftype.lower()))]
+
+
+def get_reftype(ref_file):
+    """CRDS reference file type of a reference file in lower case, as in
+    the override_<reftype> step options. REFTYPE is often upper case.
+
+    Parameters
+    ----------
+    ref_file: str or jwst.datamodels.DataModel
+        Path to reference file, or the file opened as a datamodel.
+
+    Returns
+    -------
+    reftype: str
+        Lower case reference file type, e.g. 'flat'.
+    """
+
+    if not isinstance(ref_file, datamodels.DataModel):
+        ref_file = datamodels.open(ref_file)
+
+    return ref_file.meta.reftype.lower()
+
+
 def override_reference_file(ref_file, pipeline):
-    dm = datamodels.open(ref_file)
+    reftype = get_reftype(ref_file)
+    for step in consuming_steps(pipeline, reftype):
+        setattr(getattr(pipeline, step), 'override_{}'.format(reftype), ref_file)
+        print('Setting {} in {} step'.format('override_{}'.format(reftype), step))
+
+    return pipeline
+
+
+def pipeline_reftypes(pipeline):
+    """Reference file types read by any step of a pipeline."""
+
+    reftypes = set()
+    for step in pipeline.step_defs.keys():
+        reftypes.update(getattr(getattr(pipeline, step), 'reference_file_types', []))
+
+    return reftypes
+
+
+def apply_overrides(pipeline, overrides):
+    """Hand a pipeline resolved reference files so its steps skip the CRDS
+    lookup for them.
+
+    Parameters
+    ----------
+    pipeline: jwst.stpipe.Pipeline
+        Pipeline to set override_<reftype> options on.
+    overrides: dict
+        Reference file paths keyed by reference type.
+
+    Returns
+    -------
+    pipeline: jwst.stpipe.Pipeline
+        The same pipeline.
+    """
+
+    for reftype, reference in overrides.items():
+        for step in consuming_steps(pipeline, reftype):
+            setattr(getattr(pipeline, step), 'override_{}'.format(reftype), reference)
+
+    return pipeline
+
+
+def disable_saving(pipeline):
+    """Turn off product saving for a pipeline and all of its steps."""
+
+    pipeline.save_results = False
     for step in pipeline.step_defs.keys():
-        # check if a step has an override_<reftype> option
-        if hasattr(getattr(pipeline, step), 'override_{}'.format(dm.meta.reftype)):
-            setattr(getattr(pipeline, step), 'override_{}'.format(dm.meta.reftype), ref_file)
-            print('Setting {} in {} step'.format('override_{}'.format(dm.meta.reftype), step))
+        getattr(pipeline, step).save_results = False
 
     return pipeline
 
 
-def test_reference_file(ref_file, data_file):
+def set_output_dir(pipeline, output_dir):
+    """Direct products of a pipeline and all of its steps to output_dir."""
+
+    pipeline.output_dir = output_dir
+    for step in pipeline.step_defs.keys():
+        getattr(pipeline, step).output_dir = output_dir
+
+    return pipeline
+
+
+def instrument_steps(pipeline, step_stats):
+    """Wrap every step of a pipeline so each call appends its wall time,
+    CPU time and growth of the peak resident memory to step_stats. Calls of
+    skipped steps are left out.
+
+    Parameters
+    ----------
+    pipeline: jwst.stpipe.Pipeline
+        Pipeline whose steps to wrap.
+    step_stats: list
+        List to append one dictionary per step call to.
+
+    Returns
+    -------
+    pipeline: jwst.stpipe.Pipeline
+        The same pipeline with instrumented steps.
+    """
+
+    def timed(name, step, run):
+        def wrapper(*args, **kwargs):
+            # stpipe handles skip inside run, a skipped step isn't timed.
+            if getattr(step, 'skip', False):
+                return run(*args, **kwargs)
+            wall = time.time()
+            cpu = time.process_time()
+            # ru_maxrss is in KB on linux
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            try:
+                return run(*args, **kwargs)
+            finally:
+                step_stats.append({
+                    'step': name,
+                    'wall': time.time() - wall,
+                    'cpu': time.process_time() - cpu,
+                    'peak_rss_delta_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak) / 1024.})
+        return wrapper
+
+    for name in pipeline.step_defs.keys():
+        step = getattr(pipeline, name)
+        step.run = timed(name, step, step.run)
+
+    return pipeline
+
+
+def run_steps(pipeline, steps, ref_file, reftype, step_input):
+    """Run a pipeline up to and including the last of steps, with the
+    reference file overridden and without saving any products.
+
+    The steps ahead of them run as well, so they see the same input as in
+    a full run (e.g. flat_field after assign_wcs, extract_2d and srctype).
+    Every step after the last one is skipped.
+
+    Parameters
+    ----------
+    pipeline: jwst.stpipe.Pipeline
+        Pipeline the steps belong to.
+    steps: list
+        Names of the steps that read the reference file, in order.
+    ref_file: str
+        Path to reference file, None to use the one CRDS picks.
+    reftype: str
+        CRDS reference file type of ref_file.
+    step_input: str or jwst.datamodels.DataModel
+        Input to the pipeline.
+
+    Returns
+    -------
+    result: jwst.datamodels.DataModel
+        Output of the last step run.
+    """
+
+    names = list(pipeline.step_defs.keys())
+    last = max(names.index(name) for name in steps)
+    for name in names[last + 1:]:
+        getattr(pipeline, name).skip = True
+    if ref_file is not None:
+        for name in steps:
+            setattr(getattr(pipeline, name), 'override_{}'.format(reftype), ref_file)
+    disable_saving(pipeline)
+
+    print('Running {} up to the {} step'.format(type(pipeline).__name__, names[last]))
+
+    return pipeline.run(step_input)
+
+
+def run_pipelines(pipelines, ref_file, data_file, product_cache=None, mode='full',
+                  save_intermediate=False, discard_outputs=False, output_dir=None,
+                  step_stats=None, overrides=None, memmap=False, baseline=False,
+                  run_info=None):
+    """Run a list of pipelines on a data file with the reference file
+    overridden.
+
+    The pipelines are chained in memory, each one is handed the datamodel
+    returned by the previous one. Only the last pipeline writes products
+    unless save_intermediate is set.
+
+    When a product cache is supplied and the first pipeline does not read
+    the reference file type under test, its output only depends on the data
+    file and the software versions. It is then taken from the cache (or
+    stored in it) and the run starts at the first pipeline that consumes the
+    reference file.
+
+    In 'step' mode the run stops after the last step that reads the
+    reference file type, the input of the pipeline holding it comes from the
+    pipelines upstream (cached or made on the fly). Everything downstream is
+    skipped and no products are saved.
+
+    Parameters
+    ----------
+    pipelines: list
+        Pipelines from get_pipelines.
+    ref_file: str
+        Path to reference file.
+    data_file: str
+        Path to data file.
+    product_cache: ProductCache
+        Cache of intermediate products. (Default=None, no caching)
+    mode: str
+        'full' to run every pipeline, 'step' to stop after the last step
+        that consumes the reference file. (Default='full')
+    save_intermediate: bool
+        Let pipelines before the last one save their products.
+        (Default=False)
+    discard_outputs: bool
+        Turn off product saving for every pipeline and step. (Default=False)
+    output_dir: str
+        Directory to write products to. (Default=None, current directory)
+    step_stats: list
+        If given, timing and memory of every step call are appended to it.
+    overrides: dict
+        Resolved paths of the other reference files keyed by reference type.
+        (Default=None, let CRDS resolve them)
+    memmap: bool
+        Open the data file memory mapped, so the pages that aren't modified
+        are shared with other workers through the page cache.
+        (Default=False)
+    baseline: bool
+        Leave the reference file type of ref_file to CRDS, to make the
+        product the reference file is compared against. (Default=False)
+    run_info: dict
+        If given, 'first_pipeline' is set to the index of the first
+        pipeline run, 1 when the stage 1 product came from the cache.
+
+    Returns
+    -------
+    result: jwst.datamodels.DataModel
+        Output of the last pipeline or step run.
+    """
+
+    if mode not in ('full', 'step'):
+        raise ValueError("mode must be 'full' or 'step', not {}".format(mode))
+
+    reftype = get_reftype(ref_file)
+    consumers = [consuming_steps(pipeline, reftype) for pipeline in pipelines]
+
+    if mode == 'step':
+        if not any(consumers):
+            raise ValueError('No step in {} reads {} reference files'.format(
+                [type(pipeline).__name__ for pipeline in pipelines], reftype))
+        # Nothing past the first pipeline that reads the reftype is needed.
+        last = [bool(steps) for steps in consumers].index(True)
+    else:
+        last = len(pipelines) - 1
+
+    stage_input = data_file
+    start = 0
+    cache_key = None
+
+    if product_cache is not None and len(pipelines) > 1 and not consumers[0]:
+        cache_key = make_key(file_fingerprint(data_file),
+                             type(pipelines[0]).__name__,
+                             jwst.__version__, get_context())
+        cached = product_cache.get(cache_key)
+        if cached is not None:
+            print('Using cached {} product for {}'.format(
+                type(pipelines[0]).__name__, os.path.basename(data_file)))
+            stage_input = cached
+            start = 1
+
+    if run_info is not None:
+        run_info['first_pipeline'] = start
+
+    if memmap and start == 0:
+        stage_input = datamodels.open(data_file, memmap=True)
+
+    if output_dir is not None:
+        for pipeline in pipelines:
+            set_output_dir(pipeline, output_dir)
+
+    if step_stats is not None:
+        for pipeline in pipelines:
+            instrument_steps(pipeline, step_stats)
+
+    # The reference file under test is set afterwards, so it always wins.
+    if overrides:
+        for pipeline in pipelines:
+            apply_overrides(pipeline, overrides)
+
+    result = None
+    for i, pipeline in enumerate(pipelines[start:last + 1], start):
+        if mode == 'step' and i == last:
+            return run_steps(pipeline, consumers[i], None if baseline else ref_file,
+                             reftype, stage_input)
+
+        if not baseline:
+            pipeline = override_reference_file(ref_file, pipeline)
+        if discard_outputs or (i < len(pipelines) - 1 and not save_intermediate):
+            disable_saving(pipeline)
+        result = pipeline.run(stage_input)
+
+        if result is not None:
+            if i == 0 and cache_key is not None:
+                product_cache.put(cache_key, result)
+            stage_input = result
+
+    return result
+
+
+# Keywords every reference file needs to be overridden and matched.
+REQUIRED_KEYWORDS = ['meta.reftype', 'meta.instrument.name', 'meta.useafter']
+
+
+def validate_reference_file(ref_file, exp_types):
+    """Check a reference file once, before any pipeline runs, so a broken
+    file fails right away instead of in every task.
+
+    The file is opened with strict schema validation, its required keywords
+    are checked, and the pipelines of every exposure type must have a step
+    with an override_<reftype> option for it.
+
+    Parameters
+    ----------
+    ref_file: str
+        Path to reference file.
+    exp_types: iterable
+        Exposure types of the data sets it will be tested with.
+
+    Returns
+    -------
+    None
+    """
+
+    try:
+        dm = datamodels.open(ref_file, strict_validation=True)
+        dm.validate()
+    except Exception as err:
+        raise ValueError('{} does not validate against its schema: {}'.format(ref_file, err))
+
+    flat = dm.to_flat_dict()
+    missing = [keyword for keyword in REQUIRED_KEYWORDS if flat.get(keyword) in (None, '')]
+    if missing:
+        raise ValueError('{} is missing required keywords: {}'.format(ref_file, ', '.join(missing)))
+
+    # Exposure types with the same pipelines only need checking once.
+    by_pipeline_type = {}
+    for exp_type in sorted(set(exp_types)):
+        by_pipeline_type.setdefault(get_pipeline_type(exp_type), exp_type)
+
+    reftype = get_reftype(dm)
+    for exp_type in by_pipeline_type.values():
+        pipelines = get_pipelines(exp_type)
+        if not any(consuming_steps(pipeline, reftype) for pipeline in pipelines):
+            raise ValueError('No step in {} used for {} data has an override_{} option, '
+                             '{} would never be read'.format(
+                                 [type(pipeline).__name__ for pipeline in pipelines],
+                                 exp_type, reftype, ref_file))
+
+    print('{} ({}) passed validation'.format(os.path.basename(ref_file), reftype))
+
+
+def get_context():
+    """Return the CRDS context currently used for processing."""
+
+    return crds.heavy_client.get_processing_mode('jwst')[1]
+
+
+def result_cache_key(ref_file, data_file, mode='full', ref_checksum=None):
+    """Build the result cache key for a reference file and data file pair.
+
+    The key changes whenever the reference file contents, the data file,
+    the jwst version, the CRDS context or the test mode change. Pass the
+    ref_checksum computed once per batch to avoid rereading a large
+    reference file for every data set.
+    """
+
+    if ref_checksum is None:
+        ref_checksum = file_checksum(ref_file)
+
+    return make_key(ref_checksum, file_fingerprint(data_file),
+                    jwst.__version__, get_context(), mode)
+
+
+def baseline_product(ref_file, data_file, product_cache=None, mode='full', **run_args):
+    """Product of a data file made with the reference file CRDS currently
+    picks instead of ref_file.
+
+    The baseline only depends on the data file, the test mode, the jwst
+    version and the CRDS context (and in 'step' mode on the reference file
+    type), so it is taken from the product cache when one is supplied and
+    only rerun when one of those changes.
+
+    Parameters
+    ----------
+    ref_file: str
+        Path to reference file under test, only its type is used.
+    data_file: str
+        Path to data file.
+    product_cache: ProductCache
+        Cache of baseline and intermediate products. (Default=None, no
+        caching)
+    mode: str
+        'full' or 'step', as for run_pipelines. (Default='full')
+    run_args: dict
+        Further keyword arguments for run_pipelines.
+
+    Returns
+    -------
+    baseline: jwst.datamodels.DataModel
+        Baseline product.
+    """
+
+    reftype = get_reftype(ref_file)
+    key = make_key(file_fingerprint(data_file), 'baseline', mode,
+                   reftype if mode == 'step' else None,
+                   jwst.__version__, get_context())
+    if product_cache is not None:
+        cached = product_cache.get(key)
+        if cached is not None:
+            print('Using cached baseline product for {}'.format(os.path.basename(data_file)))
+            return datamodels.open(cached)
+
+    print('Making baseline product for {}'.format(os.path.basename(data_file)))
+    baseline = run_pipelines(get_pipelines(fits.getheader(data_file)['EXP_TYPE']),
+                             ref_file, data_file, product_cache=product_cache, mode=mode,
+                             discard_outputs=True, baseline=True, **run_args)
+
+    # Containers save one file per model, only single products are cached.
+    if product_cache is not None and hasattr(baseline, 'instance'):
+        product_cache.put(key, baseline)
+
+    return baseline
+
+
+def test_reference_file(ref_file, data_file, cache=None, product_cache=None,
+                        mode='full', save_intermediate=False, discard_outputs=False,
+                        scratch_dir=None, reference_overrides=None, input_file=None,
+                        memmap=False, stats=False, max_nan_fraction=None, compare=False,
+                        output_dir=None, ref_checksum=None):
     """Override CRDS reference file with the supplied reference file and run
     pipeline with supplied data file.
     
@@ -133,6 +669,46 @@ def test_reference_file(ref_file, data_file):
         Path to reference file.
     data_file: str
         Path to data file.
+    cache: ResultCache
+        Cache to look up and store results in. (Default=None, no caching)
+    product_cache: ProductCache
+        Cache of intermediate products. (Default=None, no caching)
+    mode: str
+        'full' to run every pipeline, 'step' to stop after the last step
+        that consumes the reference file. (Default='full')
+    save_intermediate: bool
+        Save the products of pipelines before the last one. (Default=False)
+    discard_outputs: bool
+        Do not save any products. (Default=False)
+    scratch_dir: str
+        Root directory for a private scratch directory that products are
+        written to and which is removed once the run finishes.
+        (Default=None, write products to the current directory)
+    reference_overrides: dict
+        Resolved reference files keyed by data file, from
+        prewarm_references. (Default=None, let CRDS resolve them)
+    input_file: str
+        Staged copy of data_file to read instead, results still refer to
+        data_file. (Default=None, read data_file)
+    memmap: bool
+        Open the data file memory mapped. (Default=False)
+    stats: bool
+        Add statistics of the final product as Product_Stats.
+        (Default=False)
+    max_nan_fraction: float
+        With stats, mark the result SUSPECT when a larger fraction of the
+        product's data is NaN or inf. (Default=None, never)
+    compare: bool
+        Add the differences between the final product and the baseline
+        product made with the current reference file as Comparison.
+        (Default=False)
+    output_dir: str
+        Private directory, made by the caller, to run the task in instead
+        of one below scratch_dir. It is removed afterwards.
+        (Default=None)
+    ref_checksum: str
+        file_checksum of ref_file for the result cache key.
+        (Default=None, computed here)
     
     Returns
     -------
@@ -152,26 +728,150 @@ def test_reference_file(ref_file, data_file):
     result_meta = {'Path': path,
                    'Filename': filename}
 
+    if cache is not None:
+        key = result_cache_key(ref_file, data_file, mode=mode, ref_checksum=ref_checksum)
+        if stats:
+            key = make_key(key, 'stats', max_nan_fraction)
+        if compare:
+            key = make_key(key, 'compare')
+        cached = cache.get(key)
+        if cached is not None:
+            print('Using cached result for {}'.format(filename))
+            result_meta.update(cached)
+            return result_meta
+
+    start = time.time()
+    worker = psutil.Process()
+    rss_before = worker.memory_info().rss
+    step_stats = []
+    run_info = {}
+    if output_dir is None and scratch_dir is not None:
+        output_dir = tempfile.mkdtemp(prefix='reftest_', dir=scratch_dir)
+
     try:
-        for pipeline in get_pipelines(fits.getheader(data_file)['EXP_TYPE']):
-            pipeline = override_reference_file(ref_file, pipeline)
-            pipeline.run(data_file)
+        input_file = input_file or data_file
+        result = run_pipelines(get_pipelines(fits.getheader(input_file)['EXP_TYPE']),
+                               ref_file, input_file, product_cache=product_cache,
+                               mode=mode, save_intermediate=save_intermediate,
+                               discard_outputs=discard_outputs, output_dir=output_dir,
+                               step_stats=step_stats,
+                               overrides=(reference_overrides or {}).get(data_file),
+                               memmap=memmap, run_info=run_info)
         
         result_meta['Test_Status'] = 'PASSED'
         result_meta['Error_Msg'] = None
-        
-        return result_meta
+        # Only complete runs are representative for the runtime history.
+        result_meta['Full_Run'] = mode == 'full' and run_info.get('first_pipeline') == 0
 
     except Exception as err:
         result_meta['Test_Status'] = 'FAILED'
-        result_meta['Error_Msg'] = err
-        
-        return result_meta
+        result_meta['Error_Msg'] = str(err)
+        result = None
+
+    finally:
+        if output_dir is not None:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    # Only the calibration itself, the runtime estimates are built from it.
+    result_meta['Duration'] = time.time() - start
+
+    # Catch silent garbage in products that were made without errors. A
+    # problem computing the statistics doesn't fail the test.
+    if stats and result is not None:
+        try:
+            result_meta['Product_Stats'] = product_stats(result)
+        except Exception as err:
+            result_meta['Product_Stats'] = {'error': str(err)}
+        fraction = bad_fraction(result_meta['Product_Stats'])
+        if max_nan_fraction is not None and fraction is not None and fraction > max_nan_fraction:
+            result_meta['Test_Status'] = 'SUSPECT'
+            result_meta['Error_Msg'] = '{:.1%} of the product data is NaN or inf'.format(fraction)
+
+    # Like the statistics, a failing comparison doesn't fail the test.
+    if compare and result is not None:
+        try:
+            baseline = baseline_product(ref_file, input_file, product_cache=product_cache,
+                                        mode=mode,
+                                        overrides=(reference_overrides or {}).get(data_file),
+                                        memmap=memmap)
+            result_meta['Comparison'] = compare_products(baseline, result)
+        except Exception as err:
+            result_meta['Comparison'] = {'error': str(err)}
+        comparison = result_meta['Comparison']
+        if isinstance(comparison, dict) and 'fraction_changed' in comparison.get('data', {}):
+            print('{}: {:.2%} of the data changed, by at most {:.4g}'.format(
+                filename, comparison['data']['fraction_changed'],
+                comparison['data']['max_abs_diff']))
+
+    result_meta['RSS_Before_MB'] = rss_before / 2**20
+    result_meta['RSS_After_MB'] = worker.memory_info().rss / 2**20
+    result_meta['Step_Stats'] = step_stats
+
+    # Failures may be transient or fixed by the environment, e.g. when
+    # rerunning them with --rerun-failed, so they are always recalibrated.
+    if cache is not None and result_meta['Test_Status'] != 'FAILED':
+        cached = {'Test_Status': result_meta['Test_Status'],
+                  'Error_Msg': result_meta['Error_Msg']}
+        for field in ('Product_Stats', 'Comparison'):
+            if field in result_meta:
+                cached[field] = result_meta[field]
+        cache.put(key, cached)
+
+    return result_meta
+
+
+def prewarm_references(ref_file, datasets):
+    """Resolve the other reference files of every data set up front, in one
+    pass over the rmaps, and make sure they are in the local CRDS cache, so
+    the workers neither look them up nor fetch them concurrently.
+
+    Parameters
+    ----------
+    ref_file: str
+        Path to reference file under test, its type is not resolved.
+    datasets: dict
+        regression_data rows as dictionaries keyed by data file.
+
+    Returns
+    -------
+    reference_overrides: dict
+        For every data file the local reference file paths keyed by
+        reference type, for test_reference_file.
+    """
+
+    context = get_context()
+    reftype = get_reftype(ref_file)
+
+    # One exposure type per pipeline type is enough to find the reftypes.
+    exp_types = {}
+    for dataset in datasets.values():
+        exp_types.setdefault(get_pipeline_type(dataset['EXP_TYPE']), dataset['EXP_TYPE'])
+    reftypes = set()
+    for exp_type in exp_types.values():
+        for pipeline in get_pipelines(exp_type):
+            reftypes.update(pipeline_reftypes(pipeline))
+    reftypes.discard(reftype)
+
+    bestrefs = resolve_references(datasets, context, reftypes)
+    names = set(name for refs in bestrefs.values() for name in refs.values()
+                if name != 'N/A')
+    paths = sync_references(names, context)
+    paths['N/A'] = 'N/A'
+
+    print('Resolved {} reference files of {} types for {} data sets with {}'.format(
+        len(names), len(reftypes), len(datasets), context))
+
+    return {data_file: {reftype: paths[name] for reftype, name in refs.items()}
+            for data_file, refs in bestrefs.items()}
 
 
 def find_matches(ref_file, session, max_matches=-1):
-    """Find matches in user provided database based on header keywords
-    inside of user provided reference file.
+    """Find the data sets in the user provided database that CRDS would
+    calibrate with the user provided reference file, if it were delivered.
+
+    The rules of the current context's rmap, plus one for the reference file
+    built from its own selection keywords, are evaluated over the whole
+    regression_data table at once.
     
     Parameters
     ----------
@@ -190,52 +890,41 @@ def find_matches(ref_file, session, max_matches=-1):
 
     # Create a JWST datamodel based off of the reference file.
     dm = datamodels.open(ref_file)
+    flat = dm.to_flat_dict()
     
-    # Get the calibration context, pipeline map (pmap), instrument map (imap)
-    # and reference map (rmap). For more detail on these maps, visit:
+    # Get the rules of the reference map (rmap) the current calibration
+    # context uses for this instrument and reference type. For more detail
+    # on these maps, visit:
     # https://hst-crds.stsci.edu/static/users_guide/rmap_syntax.html
-    context = crds.heavy_client.get_processing_mode('jwst')[1]
-    pmap = crds.rmap.load_mapping(context)
-    imap = pmap.get_imap(dm.meta.instrument.name)
-    rmap = imap.get_rmap(dm.meta.reftype)
-    
-    meta_attrs = rmap.get_required_parkeys()
-    meta_attrs.remove('META.OBSERVATION.DATE')
-    meta_attrs.remove('META.OBSERVATION.TIME')
-
-    query_args = []
-    keys_used = []
-    
-    for attr in meta_attrs:
-        
-        # Hack to get around MIRI Dark Issue for now.
-        if attr in ['META.EXPOSURE.READPATT', 'META.SUBARRAY.NAME']:
-            continue
-
-        if p_mapping[attr].lower() in dm.to_flat_dict():
-            p_attr = p_mapping[attr]
-
-            if '|' in dm[p_attr.lower()]:
-
-                or_vals = dm[p_attr.lower()].split('|')[:-1]
-                or_vals = [val.strip() for val in or_vals]
-                query_args.append(or_(getattr(db.RegressionData, meta_to_fits[attr]) == val for val in or_vals))
-                keys_used.append([meta_to_fits[attr], dm[p_attr.lower()]])
-
-        # Ignore special CRDS-only values
-        elif dm[attr.lower()] in ['GENERIC', 'N/A', 'ANY']:
-            pass
+    rmap = get_rmap_name(get_context(), dm.meta.instrument.name, dm.meta.reftype)
+    if rmap is None:
+        params, entries = (), []
+    else:
+        params, entries = selection_table(*read_mapping(locate_mapping(rmap)))
 
-        # Normal values
+    # Test the reference file as if it had been delivered: its own selection
+    # keywords (P_ keywords where present) go ahead of the existing rules, so
+    # it replaces a rule with the same patterns and useafter date.
+    key = []
+    for attr in params:
+        p_attr = p_mapping.get(attr, '').lower()
+        if p_attr in flat:
+            key.append(flat[p_attr])
         else:
-            query_args.append(getattr(db.RegressionData, meta_to_fits[attr]) == dm[attr.lower()])
-            keys_used.append([meta_to_fits[attr], dm[attr.lower()]])
+            key.append(flat.get(attr.lower(), 'N/A'))
+    useafter = dm.meta.useafter if any(entry[1] for entry in entries) else None
+    name = os.path.basename(ref_file)
+    entries = [(tuple(key), useafter, name)] + entries
 
-    query_string = '\n'.join(['\t{} = {}'.format(key[0], key[1]) for key in keys_used])
+    query_string = '\n'.join(['\t{} = {}'.format(attr, value) for attr, value in zip(params, key)])
     print('Searching DB for test data with\n'+query_string)
-    
-    query_result = session.query(db.RegressionData).filter(*query_args)
-    filenames = [os.path.join(result.path, result.filename) for result in query_result]
+    if useafter is not None:
+        print('\tUSEAFTER = {}'.format(useafter))
+
+    frame = load_regression_frame(session, instrument=dm.meta.instrument.name)
+    matched = frame[best_references(params, entries, frame) == name]
+    filenames = [os.path.join(path, filename)
+                 for path, filename in zip(matched['path'], matched['filename'])]
     
     print('Found {} instances:'.format(len(filenames)), end="")
     print('\n'+'\n'.join(['\t'+f for f in filenames]))
@@ -246,7 +935,64 @@ def find_matches(ref_file, session, max_matches=-1):
     else:
         print('\tNo matches found')
 
-    return filenames[:max_matches]
+    if max_matches > 0:
+        return filenames[:max_matches]
+    return filenames
+
+
+def print_plan(tasks, datasets, num_cpu, options, max_memory=None):
+    """Print what a run would do and roughly what it would cost, without
+    calibrating anything.
+
+    Parameters
+    ----------
+    tasks: list
+        Tasks from order_tasks, in the order they would be started.
+    datasets: dict
+        regression_data rows as dictionaries keyed by data file.
+    num_cpu: int
+        Number of workers requested.
+    options: dict
+        Keyword arguments that would be passed to test_reference_file.
+    max_memory: float
+        Memory in bytes the workers may use in total. (Default=None, what
+        is available now)
+
+    Returns
+    -------
+    None
+    """
+
+    # Nothing is saved in step mode or with --discard-outputs.
+    if options['discard_outputs'] or options['mode'] == 'step':
+        sizes = [0] * len(tasks)
+    else:
+        sizes = [output_bytes(task, options['save_intermediate']) for task in tasks]
+
+    plan = pd.DataFrame([{'Filename': os.path.basename(task['data_file']),
+                          'EXP_TYPE': datasets[task['data_file']]['EXP_TYPE'],
+                          'Pipelines': ', '.join(PIPELINE_NAMES[task['pipeline']]),
+                          'Runtime_Min': task['estimate'] / 60,
+                          'Memory_GB': task['memory'] / 2**30,
+                          'Output_MB': size / 2**20}
+                         for task, size in zip(tasks, sizes)])
+    pd.set_option('display.max_colwidth', None)
+    print(plan)
+
+    if max_memory is None:
+        max_memory = psutil.virtual_memory().available
+    peak_memory = sum(sorted((task['memory'] for task in tasks), reverse=True)[:num_cpu])
+    suggested = suggest_num_workers(tasks, psutil.cpu_count(), max_memory)
+
+    print('Plan for {} data sets:'.format(len(tasks)))
+    print('\tCPU time        {:.1f} hours'.format(sum(task['estimate'] for task in tasks) / 3600))
+    print('\tWall time       {:.1f} hours with --num_cpu={}'.format(
+        estimate_makespan(tasks, num_cpu) / 3600, num_cpu))
+    print('\tPeak memory     {:.1f} GB with --num_cpu={}, {:.1f} GB available'.format(
+        peak_memory / 2**30, num_cpu, max_memory / 2**30))
+    print('\tOutput          {:.1f} GB'.format(sum(sizes) / 2**30))
+    print('\tSuggested       --num_cpu={} ({:.1f} hours wall time)'.format(
+        suggested, estimate_makespan(tasks, suggested) / 3600))
 
 
 def send_email(data_for_email, addr):
@@ -269,7 +1015,7 @@ def send_email(data_for_email, addr):
         addr = addr.split("@")[0]
     
     # Make sure to print full error message...
-    pd.set_option('display.max_colwidth', -1)
+    pd.set_option('display.max_colwidth', None)
     
     # Make dataframe
     df = pd.DataFrame(data_for_email)
@@ -295,6 +1041,121 @@ def send_email(data_for_email, addr):
         s.send_message(msg)
 
 
+def calibrate(ref_file, tasks, num_workers, options, history, writers=(), stopper=None,
+              client=None, **run_args):
+    """Test a reference file against every task in parallel, handing each
+    result to the writers as soon as it comes in.
+
+    Parameters
+    ----------
+    ref_file: str
+        Path to reference file.
+    tasks: list
+        Ordered tasks from order_tasks.
+    num_workers: int
+        Maximum number of tasks to run at once.
+    options: dict
+        Keyword arguments for test_reference_file.
+    history: RuntimeHistory
+        Runtime history to refine with the results, saved at the end.
+    writers: list
+        Objects with a write(record) method, e.g. ResultWriter.
+    stopper: EarlyStopper
+        Stops the batch early, killing running tasks, once it returns a
+        reason. (Default=None, run every task)
+    client: distributed.Client
+        Run the tasks on this dask.distributed cluster instead of local
+        worker processes, run_args and num_workers are then not used.
+        (Default=None, run locally)
+    run_args: dict
+        Extra keyword arguments for run_tasks.
+
+    Returns
+    -------
+    tab_data: list
+        Result records in the order they completed. On Ctrl-C only the
+        records that finished are returned.
+    """
+
+    tab_data = []
+    counts = {}
+    if client is not None:
+        # prefetch has a default and only matters with staging.
+        ignored = sorted(name for name, value in run_args.items()
+                         if value is not None and name != 'prefetch')
+        if ignored:
+            print('WARNING: {} only apply to local runs, ignored on the cluster'.format(
+                ', '.join(ignored)))
+        results = run_tasks_distributed(client, test_reference_file, tasks,
+                                        args=(ref_file,), kwargs=options)
+    else:
+        # run_tasks makes the scratch directories, so it can also remove
+        # those of killed workers.
+        results = run_tasks(test_reference_file, tasks, num_workers,
+                            args=(ref_file,), kwargs=options,
+                            scratch_dir=options.get('scratch_dir'), **run_args)
+    try:
+        for task, result in results:
+            tab_data.append(result)
+            for writer in writers:
+                writer.write(result)
+
+            counts[result['Test_Status']] = counts.get(result['Test_Status'], 0) + 1
+            print('[{}/{}] {} {} ({})'.format(
+                len(tab_data), len(tasks), result['Filename'], result['Test_Status'],
+                ', '.join('{} {}'.format(n, status) for status, n in sorted(counts.items()))))
+
+            history.update(task, result)
+
+            reason = stopper.update(task, result) if stopper is not None else None
+            if reason is not None:
+                print('Stopping early after {} of {} data sets, {}'.format(
+                    len(tab_data), len(tasks), reason))
+                break
+    except KeyboardInterrupt:
+        print('Interrupted, reporting the {} of {} results that finished'.format(
+            len(tab_data), len(tasks)))
+    finally:
+        # Kills any workers still running.
+        results.close()
+        history.save()
+
+    return tab_data
+
+
+def cache_options(args, ref_file):
+    """Open the result and product caches, evicting old entries, unless
+    --no-cache is given.
+
+    Parameters
+    ----------
+    args: dict
+        docopt arguments.
+    ref_file: str
+        Path to reference file.
+
+    Returns
+    -------
+    options: dict
+        cache, product_cache and ref_checksum for test_reference_file.
+    """
+
+    if args['--no-cache']:
+        return {'cache': None, 'product_cache': None, 'ref_checksum': None}
+
+    cache_dir = os.path.expanduser(args['--cache_dir'])
+    max_age = float(args['--cache_max_age']) if args['--cache_max_age'] else None
+    max_size = float(args['--cache_max_size']) if args['--cache_max_size'] else None
+    cache = ResultCache(cache_dir, max_age=max_age, max_size=max_size)
+    product_cache = ProductCache(cache_dir, max_age=max_age, max_size=max_size)
+    cache.evict()
+    product_cache.evict()
+
+    # Read the reference file once, not once per data set.
+    return {'cache': cache, 'product_cache': product_cache,
+            'ref_checksum': file_checksum(ref_file)}
+
+
 def main():
     """Main to parse command line arguments.
 
@@ -310,40 +1171,197 @@ def main():
     # Get docopt arguments..
     args = docopt(__doc__, version='0.1')
 
+    # Combine the results of several shards into one report.
+    if args['merge']:
+        tab_data = merge_results(args['<result_file>'], output=args['--output'])
+        print(format_step_summary(summarize_steps(tab_data)))
+        tab_data = report_records(tab_data)
+        if args['--email']:
+            send_email(tab_data, args['--email'])
+        else:
+            pd.set_option('display.max_colwidth', None)
+            print(pd.DataFrame(tab_data))
+        return
+
+    # Report what a new context would change instead of testing a file.
+    if args['impact']:
+        session = db.load_session(db_path=args['<db_path>'])
+        records = context_impact(args['<old_context>'], args['<new_context>'], session)
+        print('{} data set and reference type pairs affected'.format(len(records)))
+        impact = pd.DataFrame(records, columns=['Path', 'Filename', 'Instrument', 'Reftype',
+                                                'Old_Reference', 'New_Reference'])
+        if args['--output']:
+            impact.to_csv(args['--output'], index=False)
+        else:
+            pd.set_option('display.max_colwidth', None)
+            print(impact)
+        return
+
     ref_file = args['<ref_file>']
     data_file = args['--data']
+
+    if args['--sample'] not in ('first', 'coverage'):
+        raise ValueError("--sample must be 'first' or 'coverage', not {}".format(args['--sample']))
+
+    # --plan is a dry run over the database.
+    if args['--plan'] and data_file is not None:
+        raise ValueError('--plan works on the data sets in the database, not with --data')
+
+    # The cluster's workers aren't watched or fed by this process.
+    if args['--scheduler']:
+        local_only = [option for option in ('--max_memory', '--timeout', '--max_rss', '--stage_dir')
+                      if args[option]]
+        if local_only:
+            raise ValueError('{} only apply to local runs and cannot be used with --scheduler'.format(
+                ', '.join(local_only)))
+
+    cache_dir = os.path.expanduser(args['--cache_dir'])
+
+    # The caches are opened once we know calibration will happen.
+    options = {'cache': None,
+               'product_cache': None,
+               'ref_checksum': None,
+               'mode': args['--mode'],
+               'save_intermediate': args['--save_intermediate'],
+               'discard_outputs': args['--discard-outputs'],
+               'scratch_dir': args['--scratch_dir'],
+               'memmap': args['--mmap'],
+               'stats': args['--stats'],
+               'max_nan_fraction': float(args['--max_nan']) if args['--max_nan'] else None,
+               'compare': args['--compare']}
     
     # if you only want to test one JWST file against ref file
     # else, search DB for files that will be effected by new ref file
     if data_file is not None:
-        file_to_cal = delayed(test_reference_file)(ref_file, data_file)
+        validate_reference_file(ref_file, [fits.getheader(data_file)['EXP_TYPE']])
+        options.update(cache_options(args, ref_file))
+        file_to_cal = delayed(test_reference_file)(ref_file, data_file, **options)
         tab_data = file_to_cal.compute()
-        pd.set_option('display.max_colwidth', -1)
+        pd.set_option('display.max_colwidth', None)
         print(pd.DataFrame(tab_data))
     else:
         session = db.load_session(db_path=args['<db_path>'])
-        if args['--max_matches']:
+        if args['--rerun-failed']:
+            # Runs made with --mini recorded the mini copies.
+            data_files = db.parent_datasets(
+                session, db.failed_datasets(session, int(args['--rerun-failed'])))
+            print('Rerunning {} data sets that did not pass in run {}'.format(
+                len(data_files), args['--rerun-failed']))
+        elif args['--max_matches'] and args['--sample'] == 'first':
             data_files = find_matches(ref_file, session, max_matches=int(args['--max_matches']))
         else:
             data_files = find_matches(ref_file, session)
-        # If files are returned, build list of objects to process
+        # If files are returned, build list of tasks to process
         if data_files:
-            delayed_data_files = [delayed(test_reference_file)(ref_file, fname) 
-                                  for fname in data_files]
+            datasets = db.lookup_datasets(session, data_files)
+            missing = [data_file for data_file in data_files if data_file not in datasets]
+            if missing:
+                print('WARNING: skipping {} data sets that are no longer in the database, '
+                      'e.g. {}'.format(len(missing), missing[0]))
+                data_files = [data_file for data_file in data_files if data_file in datasets]
+
+            # Screen with the mini copies of the data sets instead.
+            if args['--mini']:
+                minis = db.lookup_minis(session, data_files)
+                print('Using {} mini data sets, {} data sets have none'.format(
+                    len(minis), len(data_files) - len(minis)))
+                datasets = {os.path.join(mini['path'], mini['filename']):
+                            dict(datasets[data_file], **{key: mini[key] for key in
+                                 ['path', 'filename', 'NINTS', 'NGROUPS', 'SUBSIZE1', 'SUBSIZE2']})
+                            for data_file, mini in minis.items() if data_file in datasets}
+                data_files = list(datasets)
+            tasks = [make_task(fname, datasets[fname],
+                               get_pipeline_type(datasets[fname]['EXP_TYPE']))
+                     for fname in data_files]
+
+            # Start the most expensive data sets first.
+            history = RuntimeHistory(os.path.join(cache_dir, 'runtimes.json'))
+            tasks = order_tasks(tasks, history)
+
+            # Spend the --max_matches budget on as many observing modes as possible.
+            if args['--sample'] == 'coverage' and args['--max_matches']:
+                tasks = order_tasks(sample_coverage(tasks, datasets, int(args['--max_matches'])),
+                                    history)
+
+            # Only keep this host's share of the batch.
+            if args['--shard']:
+                index, count = parse_shard(args['--shard'])
+                n_tasks = len(tasks)
+                tasks = shard_tasks(tasks, index, count)
+                print('Shard {}: testing {} of {} data sets'.format(args['--shard'], len(tasks), n_tasks))
+
+            stopper = None
+            if args['--adaptive']:
+                tasks = order_in_waves(tasks, datasets)
+                stopper = EarlyStopper(
+                    tasks, datasets, max_failures=int(args['--fail_fast']),
+                    passes_per_mode=int(args['--passes_per_mode']) if args['--passes_per_mode'] else None)
+
+            max_memory = float(args['--max_memory']) * 2**30 if args['--max_memory'] else None
+            if args['--plan']:
+                print_plan(tasks, datasets, int(args['--num_cpu']), options, max_memory)
+                return
+
+            # Stop here if every task would fail on the reference file itself.
+            validate_reference_file(ref_file,
+                                    [datasets[task['data_file']]['EXP_TYPE'] for task in tasks])
+            options.update(cache_options(args, ref_file))
+
+            client = None
+            if args['--scheduler']:
+                # The cluster, not this machine, limits how many tasks run.
+                client = get_client(args['--scheduler'], n_workers=int(args['--num_cpu']))
+                if not cluster_capacity(client):
+                    raise ValueError("NO WORKERS ARE CONNECTED TO {}".format(args['--scheduler']))
             # Check to make sure user isn't exceeding number of CPUs.
-            if int(args['--num_cpu']) > psutil.cpu_count():
+            elif int(args['--num_cpu']) > psutil.cpu_count():
                 args = (psutil.cpu_count(), args['--num_cpu'])
                 err_str = "YOUR MACHINE ONLY HAS {} CPUs! YOU ENTERED {}"       
                 raise ValueError(err_str.format(*args))
-            else:
-                # Compute results in parallel.
-                print("Performing Calibration...")
-                with ProgressBar():
-                    tab_data = compute(delayed_data_files, num_workers=int(args['--num_cpu']))[0]
-            
+
+            if args['--prewarm']:
+                options['reference_overrides'] = prewarm_references(
+                    ref_file, {task['data_file']: datasets[task['data_file']] for task in tasks})
+
+            staging = None
+            if args['--stage_dir']:
+                staging = StagingCache(args['--stage_dir'],
+                                       max_size=float(args['--stage_max_size']) * 2**10)
+                staging.evict()
+
+            # Compute results in parallel.
+            print("Performing Calibration...")
+            db_writer = db.ResultDBWriter(args['<db_path>'], ref_file,
+                                          jwst.__version__, get_context())
+            print('Recording results in {} as run {}'.format(args['<db_path>'],
+                                                             db_writer.run_id))
+            writers = [db_writer]
+            if args['--output']:
+                writers.append(ResultWriter(args['--output']))
+            try:
+                tab_data = calibrate(
+                    ref_file, tasks, int(args['--num_cpu']), options, history,
+                    writers=writers, stopper=stopper, client=client,
+                    max_memory=max_memory,
+                    timeout=float(args['--timeout']) * 60 if args['--timeout'] else None,
+                    max_rss=float(args['--max_rss']) * 2**30 if args['--max_rss'] else None,
+                    staging=staging, prefetch=int(args['--prefetch']))
+            finally:
+                for writer in writers:
+                    writer.close()
+                if client is not None:
+                    client.close()
+
+            # Build the report from what actually made it to disk.
+            if args['--output']:
+                tab_data = read_results(args['--output'])
+
+            print(format_step_summary(summarize_steps(tab_data)))
+            tab_data = report_records(tab_data)
+
             # If you want to email, 
             if args['--email']:
                 send_email(tab_data, args['--email'])
             else:
-                pd.set_option('display.max_colwidth', -1)
-                print(pd.DataFrame(tab_data))
\ No newline at end of file
+                pd.set_option('display.max_colwidth', None)
+                print(pd.DataFrame(tab_data))
@@ -0,0 +1,227 @@
+"""Writing and reading test result records."""
+
+import csv
+import json
+import os
+
+import numpy as np
+
+
+# Columns written to CSV result files, other fields are only kept in JSONL.
+CSV_COLUMNS = ['Path', 'Filename', 'Test_Status', 'Error_Msg', 'Duration',
+               'Peak_RSS_MB', 'RSS_Before_MB', 'RSS_After_MB', 'Step_Stats', 'Product_Stats',
+               'Comparison']
+
+# CSV columns holding numbers and nested fields stored as JSON strings.
+CSV_NUMERIC = ['Duration', 'Peak_RSS_MB', 'RSS_Before_MB', 'RSS_After_MB']
+CSV_NESTED = ['Step_Stats', 'Product_Stats', 'Comparison']
+
+# Fields every record has, a missing value is None rather than absent.
+CSV_REQUIRED = ['Path', 'Filename', 'Test_Status', 'Error_Msg']
+
+# Nested fields left out of the printed and emailed tables.
+REPORT_EXCLUDE = ['Step_Stats', 'Product_Stats', 'Comparison']
+
+
+class ResultWriter(object):
+    """Append result records to a JSONL or CSV file as they come in, so
+    nothing is lost if the job dies part way through.
+
+    Parameters
+    ----------
+    filename: str
+        File to write, the format follows the extension (.csv or .jsonl).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.csv = filename.endswith('.csv')
+        self._file = open(filename, 'w')
+
+        if self.csv:
+            self._writer = csv.DictWriter(self._file, fieldnames=CSV_COLUMNS,
+                                          extrasaction='ignore')
+            self._writer.writeheader()
+
+    def write(self, record):
+        if self.csv:
+            # Nested fields are stored as JSON strings.
+            self._writer.writerow({key: json.dumps(value) if isinstance(value, (list, dict)) else value
+                                   for key, value in record.items()})
+        else:
+            self._file.write(json.dumps(record, default=str) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_results(filename):
+    """Read result records written by ResultWriter. Records read from CSV
+    get their numbers, nested fields and None values back, so a report is
+    the same whichever format it was streamed to.
+
+    Parameters
+    ----------
+    filename: str
+        JSONL or CSV result file.
+
+    Returns
+    -------
+    records: list
+        List of result dictionaries.
+    """
+
+    with open(filename) as f:
+        if filename.endswith('.csv'):
+            return [_from_csv(row) for row in csv.DictReader(f)]
+
+        # A job killed mid write can leave a truncated last line.
+        records = []
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+
+    return records
+
+
+def _from_csv(row):
+    """Restore the types of a record read from a CSV result file, so it
+    matches the record that was written.
+    """
+
+    record = {}
+    for key, value in row.items():
+        if value == '':
+            # CSV writes None and fields the record didn't have as ''.
+            if key in CSV_REQUIRED:
+                record[key] = None
+        elif key in CSV_NESTED:
+            record[key] = json.loads(value)
+        elif key in CSV_NUMERIC:
+            record[key] = float(value)
+        else:
+            record[key] = value
+
+    return record
+
+
+def report_records(records):
+    """Strip the nested fields from result records for display."""
+
+    return [{key: value for key, value in record.items() if key not in REPORT_EXCLUDE}
+            for record in records]
+
+
+def count_status(records):
+    """Count result records by Test_Status.
+
+    Returns
+    -------
+    counts: dict
+        Number of records for each status.
+    """
+
+    counts = {}
+    for record in records:
+        counts[record['Test_Status']] = counts.get(record['Test_Status'], 0) + 1
+
+    return counts
+
+
+def summarize_steps(records):
+    """Aggregate the per step timing of many result records.
+
+    Parameters
+    ----------
+    records: list
+        Result records with a Step_Stats field.
+
+    Returns
+    -------
+    summary: dict
+        For each step the number of calls and the 50th and 95th percentiles
+        of wall time, CPU time and peak memory growth.
+    """
+
+    by_step = {}
+    for record in records:
+        step_stats = record.get('Step_Stats') or []
+        for stat in step_stats:
+            by_step.setdefault(stat['step'], []).append(stat)
+
+    summary = {}
+    for step, stats in by_step.items():
+        summary[step] = {'n': len(stats)}
+        for field in ['wall', 'cpu', 'peak_rss_delta_mb']:
+            values = np.array([stat[field] for stat in stats])
+            summary[step][field + '_p50'] = np.percentile(values, 50)
+            summary[step][field + '_p95'] = np.percentile(values, 95)
+
+    return summary
+
+
+def format_step_summary(summary):
+    """Format the output of summarize_steps as text, slowest steps first."""
+
+    lines = ['Per step summary (p50/p95):']
+    for step in sorted(summary, key=lambda step: summary[step]['wall_p95'], reverse=True):
+        stats = summary[step]
+        lines.append('\t{:<20} n={:<5} wall = {:.0f} s/{:.0f} s  cpu = {:.0f} s/{:.0f} s  '
+                     'peak rss += {:.0f} MB/{:.0f} MB'.format(
+                         step, stats['n'], stats['wall_p50'], stats['wall_p95'],
+                         stats['cpu_p50'], stats['cpu_p95'],
+                         stats['peak_rss_delta_mb_p50'], stats['peak_rss_delta_mb_p95']))
+
+    return '\n'.join(lines)
+
+
+def merge_results(result_files, output=None):
+    """Combine the result files of several shards.
+
+    Parameters
+    ----------
+    result_files: list
+        JSONL or CSV result files written with --output.
+    output: str
+        Write the combined records to this .jsonl or .csv file.
+        (Default=None, don't write)
+
+    Returns
+    -------
+    tab_data: list
+        Result records of all files.
+    """
+
+    tab_data = []
+    seen = set()
+    for result_file in result_files:
+        records = read_results(result_file)
+        print('{}: {} results'.format(result_file, len(records)))
+        for record in records:
+            key = (record['Path'], record['Filename'])
+            if key in seen:
+                print('WARNING: {} appears in more than one result file'.format(
+                    os.path.join(*key)))
+            seen.add(key)
+            tab_data.append(record)
+
+    counts = count_status(tab_data)
+    print('Merged {} results ({})'.format(
+        len(tab_data), ', '.join('{} {}'.format(n, status) for status, n in sorted(counts.items()))))
+
+    if output:
+        with ResultWriter(output) as writer:
+            for record in tab_data:
+                writer.write(record)
+
+    return tab_data
@@ -0,0 +1,180 @@
+"""Choosing which matched data sets to test."""
+
+import re
+
+
+# regression_data columns that make up a data set's observing mode.
+MODE_KEYWORDS = ['EXP_TYPE', 'DETECTOR', 'SUBARRAY', 'READPATT', 'FILTER',
+                 'PUPIL', 'GRATING', 'BAND', 'CHANNEL']
+
+
+def mode_signature(dataset):
+    """Observing mode of a data set.
+
+    Parameters
+    ----------
+    dataset: dict
+        regression_data row as a dictionary.
+
+    Returns
+    -------
+    signature: tuple
+        Values of MODE_KEYWORDS.
+    """
+
+    return tuple(dataset.get(key) for key in MODE_KEYWORDS)
+
+
+def sample_coverage(tasks, datasets, budget):
+    """Pick at most budget tasks covering as many distinct observing modes
+    as possible, preferring the cheapest data set of each mode.
+
+    Only the cheapest task of every mode signature is considered at first.
+    Tasks are then picked greedily by how many keyword values they add that
+    are not covered yet, with ties going to the cheaper task. Once every
+    signature is in, leftover budget goes to the cheapest remaining tasks.
+
+    Parameters
+    ----------
+    tasks: list
+        Tasks with an 'estimate' from order_tasks.
+    datasets: dict
+        regression_data rows as dictionaries keyed by data file.
+    budget: int
+        Maximum number of tasks to return.
+
+    Returns
+    -------
+    tasks: list
+        The chosen tasks.
+    """
+
+    cheapest = {}
+    for task in tasks:
+        signature = mode_signature(datasets[task['data_file']])
+        if signature not in cheapest or task['estimate'] < cheapest[signature]['estimate']:
+            cheapest[signature] = task
+
+    candidates = list(cheapest.items())
+    covered = set()
+    chosen = []
+    while candidates and len(chosen) < budget:
+        def score(item):
+            signature, task = item
+            new_values = set(zip(MODE_KEYWORDS, signature)) - covered
+            return (len(new_values), -task['estimate'])
+
+        best = max(candidates, key=score)
+        candidates.remove(best)
+        covered.update(zip(MODE_KEYWORDS, best[0]))
+        chosen.append(best[1])
+
+    if len(chosen) < budget:
+        chosen_files = set(task['data_file'] for task in chosen)
+        rest = sorted((task for task in tasks if task['data_file'] not in chosen_files),
+                      key=lambda task: task['estimate'])
+        chosen.extend(rest[:budget - len(chosen)])
+
+    print('Sampled {} data sets covering {} of {} observing modes'.format(
+        len(chosen), min(len(chosen), len(cheapest)), len(cheapest)))
+
+    return chosen
+
+
+def order_in_waves(tasks, datasets):
+    """Order tasks in waves that each hold one data set of every observing
+    mode, cheapest first within a mode, so early results span all modes.
+
+    Parameters
+    ----------
+    tasks: list
+        Tasks with an 'estimate' from order_tasks.
+    datasets: dict
+        regression_data rows as dictionaries keyed by data file.
+
+    Returns
+    -------
+    tasks: list
+        Tasks ordered wave by wave, longest first within each wave.
+    """
+
+    by_mode = {}
+    for task in sorted(tasks, key=lambda task: task['estimate']):
+        by_mode.setdefault(mode_signature(datasets[task['data_file']]), []).append(task)
+
+    ordered = []
+    wave = 0
+    while True:
+        current = [mode_tasks[wave] for mode_tasks in by_mode.values() if len(mode_tasks) > wave]
+        if not current:
+            return ordered
+        ordered.extend(sorted(current, key=lambda task: task['estimate'], reverse=True))
+        wave += 1
+
+
+def error_signature(msg):
+    """Reduce an error message to a signature shared by the same failure on
+    different data sets, by masking paths and numbers.
+    """
+
+    msg = re.sub(r'\S*/\S*', '<path>', str(msg))
+    msg = re.sub(r'\d+(\.\d+)?', '#', msg)
+
+    return msg.strip()[:200]
+
+
+class EarlyStopper(object):
+    """Decide when a batch has already told its story.
+
+    Parameters
+    ----------
+    tasks: list
+        All tasks of the batch.
+    datasets: dict
+        regression_data rows as dictionaries keyed by data file.
+    max_failures: int
+        Stop once this many failures share an error signature.
+        (Default=None, never)
+    passes_per_mode: int
+        Stop once every observing mode passed this many times, or on all of
+        its data sets if it has fewer. (Default=None, never)
+    """
+
+    def __init__(self, tasks, datasets, max_failures=None, passes_per_mode=None):
+        self.datasets = datasets
+        self.max_failures = max_failures
+        self.passes_per_mode = passes_per_mode
+        self.failures = {}
+        self.passes = {}
+        self.needed = {}
+
+        if passes_per_mode is not None:
+            for task in tasks:
+                signature = mode_signature(datasets[task['data_file']])
+                self.needed[signature] = min(self.needed.get(signature, 0) + 1,
+                                             passes_per_mode)
+
+    def update(self, task, result):
+        """Take in a result.
+
+        Returns
+        -------
+        reason: str
+            Why the batch should stop, or None to carry on.
+        """
+
+        if result['Test_Status'] == 'PASSED':
+            signature = mode_signature(self.datasets[task['data_file']])
+            self.passes[signature] = self.passes.get(signature, 0) + 1
+        else:
+            signature = error_signature(result['Error_Msg'])
+            self.failures[signature] = self.failures.get(signature, 0) + 1
+            if self.max_failures is not None and self.failures[signature] >= self.max_failures:
+                return '{} data sets failed with: {}'.format(self.failures[signature], signature)
+
+        if self.passes_per_mode is not None:
+            if all(self.passes.get(signature, 0) >= n for signature, n in self.needed.items()):
+                return 'all {} observing modes passed at least {} times'.format(
+                    len(self.needed), self.passes_per_mode)
+
+        return None
@@ -0,0 +1,556 @@
+"""Cost estimates, ordering and parallel execution of calibration tasks."""
+
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import json
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+import psutil
+
+
+# Default seconds per ramp sample (NINTS x NGROUPS x pixels) and fixed
+# start up overhead for each pipeline type returned by get_pipeline_type.
+DEFAULT_RATES = {'dark': 2e-8,
+                 'detector1': 2e-8,
+                 'image': 3e-8,
+                 'spec': 5e-8}
+OVERHEAD = 20.
+
+# Default peak bytes per ramp sample for each pipeline type, the ramp is held
+# as float32 data and err plus uint8 groupdq, with a few working copies, and
+# the baseline memory of a worker with jwst imported.
+DEFAULT_BYTES_PER_SAMPLE = {'dark': 20.,
+                            'detector1': 20.,
+                            'image': 24.,
+                            'spec': 24.}
+BASE_MEMORY = 500 * 2**20
+
+# Bytes per pixel of the products the pipelines save: rate and rateints hold
+# data, err and three variance arrays as float32 plus a uint32 dq array, the
+# stage 2 cal and resampled products add a flat field variance.
+STAGE1_BYTES_PER_PIXEL = 24
+STAGE2_BYTES_PER_PIXEL = 28
+
+
+def _int(value, default):
+    """Convert a header or DB value to int, falling back to default."""
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def make_task(data_file, keywords, pipeline):
+    """Describe one calibration task.
+
+    Parameters
+    ----------
+    data_file: str
+        Path to data file.
+    keywords: dict-like
+        Header keywords or regression_data columns of the data file.
+    pipeline: str
+        Pipeline type from get_pipeline_type.
+
+    Returns
+    -------
+    task: dict
+        Data file, pipeline type and ramp dimensions.
+    """
+
+    return {'data_file': data_file,
+            'pipeline': pipeline,
+            'nints': _int(keywords.get('NINTS'), 1),
+            'ngroups': _int(keywords.get('NGROUPS'), 1),
+            'nx': _int(keywords.get('SUBSIZE1'), 2048),
+            'ny': _int(keywords.get('SUBSIZE2'), 2048)}
+
+
+def task_samples(task):
+    """Number of ramp samples (NINTS x NGROUPS x SUBSIZE1 x SUBSIZE2)."""
+
+    return task['nints'] * task['ngroups'] * task['nx'] * task['ny']
+
+
+def raw_memory(task):
+    """Uncorrected peak memory estimate of a task's data in bytes."""
+
+    bytes_per_sample = DEFAULT_BYTES_PER_SAMPLE.get(task['pipeline'],
+                                                    max(DEFAULT_BYTES_PER_SAMPLE.values()))
+
+    return bytes_per_sample * task_samples(task)
+
+
+def output_bytes(task, save_intermediate=False):
+    """Estimated size in bytes of the products a task saves.
+
+    Parameters
+    ----------
+    task: dict
+        Task from make_task.
+    save_intermediate: bool
+        Whether stage 1 products are saved ahead of stage 2.
+
+    Returns
+    -------
+    nbytes: float
+        Estimated size of the products.
+    """
+
+    pixels = task['nx'] * task['ny']
+    if task['pipeline'] == 'dark':
+        # float32 data plus uint8 groupdq for every ramp sample.
+        return 5 * task_samples(task)
+
+    stage1 = STAGE1_BYTES_PER_PIXEL * pixels * (1 + task['nints'])
+    if task['pipeline'] == 'detector1':
+        return stage1
+
+    stage2 = 2 * STAGE2_BYTES_PER_PIXEL * pixels
+
+    return stage2 + stage1 if save_intermediate else stage2
+
+
+class RuntimeHistory(object):
+    """Seconds per ramp sample and a peak memory correction factor for each
+    pipeline type, learned from the runtimes and peak RSS of past runs and
+    kept in a JSON file.
+
+    Parameters
+    ----------
+    filename: str
+        JSON file to load from and save to.
+    alpha: float
+        Weight of a new observation in the running average.
+    """
+
+    def __init__(self, filename, alpha=0.3):
+        self.filename = filename
+        self.alpha = alpha
+        self.rates = dict(DEFAULT_RATES)
+        self.memory_factors = {}
+
+        if os.path.exists(filename):
+            with open(filename) as f:
+                history = json.load(f)
+            self.rates.update(history.get('rates', {}))
+            self.memory_factors.update(history.get('memory_factors', {}))
+
+    def rate(self, pipeline):
+        return self.rates.get(pipeline, max(DEFAULT_RATES.values()))
+
+    def memory_factor(self, pipeline):
+        return self.memory_factors.get(pipeline, 1.)
+
+    def estimate(self, task):
+        """Estimated wall time of a task in seconds."""
+
+        return OVERHEAD + self.rate(task['pipeline']) * task_samples(task)
+
+    def estimate_memory(self, task):
+        """Estimated peak memory of a task in bytes."""
+
+        return BASE_MEMORY + self.memory_factor(task['pipeline']) * raw_memory(task)
+
+    def update(self, task, result):
+        """Refine the rate and memory factor of a task's pipeline type from
+        the Duration and Peak_RSS_MB of its result record.
+
+        Only runs that passed and ran every pipeline in full are used. Step
+        mode runs, runs that started from a cached stage 1 product and
+        failures stop early and would drag the estimates down.
+        """
+
+        if result.get('Test_Status') != 'PASSED' or not result.get('Full_Run'):
+            return
+
+        pipeline = task['pipeline']
+        samples = task_samples(task)
+        if samples <= 0:
+            return
+
+        duration = result.get('Duration')
+        if duration is not None and duration > OVERHEAD:
+            observed = (duration - OVERHEAD) / samples
+            self.rates[pipeline] = (1 - self.alpha) * self.rate(pipeline) + self.alpha * observed
+
+        peak_rss = result.get('Peak_RSS_MB')
+        if peak_rss is not None and peak_rss * 2**20 > BASE_MEMORY:
+            observed = (peak_rss * 2**20 - BASE_MEMORY) / raw_memory(task)
+            self.memory_factors[pipeline] = ((1 - self.alpha) * self.memory_factor(pipeline) +
+                                             self.alpha * observed)
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(self.filename, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'rates': self.rates,
+                       'memory_factors': self.memory_factors}, f, indent=2)
+        os.replace(tmp_path, self.filename)
+
+
+def order_tasks(tasks, history):
+    """Sort tasks longest first so the biggest data sets don't end up
+    running alone at the tail of the batch.
+
+    Parameters
+    ----------
+    tasks: list
+        Tasks from make_task.
+    history: RuntimeHistory
+        Source of runtime estimates.
+
+    Returns
+    -------
+    tasks: list
+        Tasks with an 'estimate' in seconds and a 'memory' estimate in bytes,
+        sorted by 'estimate' in descending order.
+    """
+
+    for task in tasks:
+        task['estimate'] = history.estimate(task)
+        task['memory'] = history.estimate_memory(task)
+
+    return sorted(tasks, key=lambda task: task['estimate'], reverse=True)
+
+
+def estimate_makespan(tasks, num_workers):
+    """Estimated wall time in seconds of running tasks in list order on
+    num_workers workers, each task going to the first worker that frees up.
+    """
+
+    workers = [0.] * max(1, min(num_workers, len(tasks)))
+    for task in tasks:
+        heapq.heappush(workers, heapq.heappop(workers) + task['estimate'])
+
+    return max(workers)
+
+
+def suggest_num_workers(tasks, max_workers, max_memory):
+    """Largest number of workers, up to max_workers and the number of tasks,
+    that can run the most memory hungry tasks side by side within max_memory.
+    """
+
+    memory = sorted((task['memory'] for task in tasks), reverse=True)
+    num_workers = 1
+    while (num_workers < min(max_workers, len(memory)) and
+           sum(memory[:num_workers + 1]) <= max_memory):
+        num_workers += 1
+
+    return num_workers
+
+
+def parse_shard(shard):
+    """Parse a shard given as 'i/n' into (i, n), i counting from 0."""
+
+    try:
+        index, count = (int(value) for value in shard.split('/'))
+    except ValueError:
+        raise ValueError("--shard must look like i/n, not {}".format(shard))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("--shard {} is out of range, i must be 0 to n-1".format(shard))
+
+    return index, count
+
+
+def shard_tasks(tasks, index, count):
+    """Pick the tasks of one shard out of count, balanced by cost.
+
+    Tasks are dealt out longest first, each to the shard with the least work
+    so far, so all shards finish at about the same time. The cost is the
+    estimate from DEFAULT_RATES, not the local runtime history, so every
+    host computes the same partition from the same task list.
+
+    Parameters
+    ----------
+    tasks: list
+        Tasks from make_task.
+    index: int
+        Shard to return, from 0 to count - 1.
+    count: int
+        Number of shards.
+
+    Returns
+    -------
+    tasks: list
+        Tasks of the shard, in their original order.
+    """
+
+    def cost(task):
+        rate = DEFAULT_RATES.get(task['pipeline'], max(DEFAULT_RATES.values()))
+        return OVERHEAD + rate * task_samples(task)
+
+    loads = [(0., shard) for shard in range(count)]
+    chosen = set()
+    for task in sorted(tasks, key=lambda task: (-cost(task), task['data_file'])):
+        load, shard = heapq.heappop(loads)
+        if shard == index:
+            chosen.add(task['data_file'])
+        heapq.heappush(loads, (load + cost(task), shard))
+
+    return [task for task in tasks if task['data_file'] in chosen]
+
+
+def failed_record(task, status, msg):
+    """Result record for a task whose worker did not return one."""
+
+    path, filename = os.path.split(task['data_file'])
+
+    return {'Path': path,
+            'Filename': filename,
+            'Test_Status': status,
+            'Error_Msg': msg}
+
+
+def process_rss(pid):
+    """Resident memory in bytes of a process and all of its children."""
+
+    try:
+        proc = psutil.Process(pid)
+        procs = [proc] + proc.children(recursive=True)
+        return sum(p.memory_info().rss for p in procs)
+    except psutil.Error:
+        return 0
+
+
+def kill_process(proc):
+    """Kill a worker process and anything it started."""
+
+    try:
+        children = psutil.Process(proc.pid).children(recursive=True)
+    except psutil.Error:
+        children = []
+
+    for child in children:
+        try:
+            child.kill()
+        except psutil.Error:
+            pass
+    proc.kill()
+    proc.join()
+
+
+def _run_task(function, args, task, kwargs, conn):
+    """Worker process entry point, send the task result back to the parent."""
+
+    # Ctrl-C is handled by the parent, which shuts the workers down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Read a staged copy of the data file if there is one.
+    if task.get('input_file') is not None:
+        kwargs = dict(kwargs, input_file=task['input_file'])
+    if task.get('output_dir') is not None:
+        kwargs = dict(kwargs, output_dir=task['output_dir'])
+
+    try:
+        result = function(*(tuple(args) + (task['data_file'],)), **kwargs)
+    except Exception as err:
+        result = failed_record(task, 'FAILED', str(err))
+
+    conn.send(result)
+    conn.close()
+
+
+def _next_admissible(pending, running, max_memory, ready=None):
+    """Pick the first pending task whose memory estimate fits.
+
+    The memory the running tasks are still expected to grab, their estimate
+    less what they already use, is held back from what is available. Tasks
+    for which ready returns False, e.g. because their input is still being
+    staged, are passed over.
+    """
+
+    available = psutil.virtual_memory().available
+    for task in running.values():
+        available -= max(0, task.get('memory', 0) - task['rss'])
+    if max_memory is not None:
+        in_use = sum(max(task.get('memory', 0), task['rss']) for task in running.values())
+        available = min(available, max_memory - in_use)
+
+    for i, task in enumerate(pending):
+        if task.get('memory', 0) <= available and (ready is None or ready(task)):
+            return i
+
+    # Nothing fits, run the head of the queue on its own rather than stall.
+    if not running and (ready is None or ready(pending[0])):
+        print('WARNING: {} is estimated to need {:.1f} GB, more than is available'.format(
+            os.path.basename(pending[0]['data_file']), pending[0].get('memory', 0) / 2**30))
+        return 0
+
+    return None
+
+
+def _stage(staging, task):
+    """Stage a task's data file, falling back to the original on errors."""
+
+    try:
+        return staging.stage(task['data_file'])
+    except (IOError, OSError) as err:
+        print('WARNING: could not stage {}, reading it in place: {}'.format(
+            task['data_file'], err))
+        return None
+
+
+def run_tasks(function, tasks, num_workers, args=(), kwargs=None, poll=1.,
+              max_memory=None, timeout=None, max_rss=None, staging=None, prefetch=2,
+              scratch_dir=None):
+    """Run function(*args, task['data_file'], **kwargs) for every task, each
+    in a fresh worker process, with at most num_workers running at once.
+
+    Tasks are started in list order as long as their 'memory' estimate fits
+    in the memory that is available. Otherwise the next task that fits is
+    started instead. The resident memory of every worker is sampled while it
+    runs and its peak is added to the result as Peak_RSS_MB.
+
+    A worker that runs longer than timeout or grows beyond max_rss is killed
+    and its task recorded as TIMEOUT or OOM, the rest of the batch carries
+    on. If the caller stops iterating, e.g. on Ctrl-C, the running workers
+    are killed.
+
+    With a staging cache the data files are copied to local storage in
+    background threads, prefetch tasks ahead of the ones being started, and
+    the workers get the copy as input_file. A task is only started once its
+    copy is done, meanwhile the running workers are still watched and their
+    results collected.
+
+    With a scratch directory every task gets a private directory below it
+    as output_dir. It is made and removed here, so the products of a
+    killed worker don't linger.
+
+    Parameters
+    ----------
+    function: func
+        Function returning a result record.
+    tasks: list
+        Tasks from make_task, in the order they should be started.
+    num_workers: int
+        Maximum number of tasks to run at once.
+    args: tuple
+        Positional arguments passed ahead of the data file.
+    kwargs: dict
+        Keyword arguments passed to function.
+    poll: float
+        Seconds between checks on the running workers.
+    max_memory: float
+        Memory in bytes the tasks may use in total. (Default=None, whatever
+        psutil reports as available)
+    timeout: float
+        Wall time limit in seconds for each task. (Default=None, no limit)
+    max_rss: float
+        Resident memory limit in bytes for each task. (Default=None, no limit)
+    staging: StagingCache
+        Cache to stage data files in. (Default=None, read them in place)
+    prefetch: int
+        Number of pending tasks to stage ahead. (Default=2)
+    scratch_dir: str
+        Root of the per task output directories. (Default=None, none)
+
+    Yields
+    ------
+    task, result: dict, dict
+        Each task with its result record, in the order they complete.
+    """
+
+    kwargs = kwargs or {}
+    pending = list(tasks)
+    running = {}
+    procs = {}
+    staged = {}
+    executor = ThreadPoolExecutor(max_workers=max(1, prefetch)) if staging is not None else None
+
+    def ready(task):
+        return staging is None or (task['data_file'] in staged and
+                                   staged[task['data_file']].done())
+
+    def release(task):
+        if staging is not None and task.get('input_file') is not None:
+            staging.release(task['data_file'])
+        if task.get('output_dir') is not None:
+            shutil.rmtree(task['output_dir'], ignore_errors=True)
+
+    try:
+        while pending or running:
+            while pending and len(running) < num_workers:
+                if staging is not None:
+                    for ahead in pending[:max(1, prefetch)]:
+                        if ahead['data_file'] not in staged:
+                            staged[ahead['data_file']] = executor.submit(_stage, staging, ahead)
+                index = _next_admissible(pending, running, max_memory, ready=ready)
+                if index is None:
+                    break
+                task = pending.pop(index)
+                if staging is not None:
+                    task['input_file'] = staged.pop(task['data_file']).result()
+                if scratch_dir is not None:
+                    task['output_dir'] = tempfile.mkdtemp(prefix='reftest_', dir=scratch_dir)
+                parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+                proc = multiprocessing.Process(target=_run_task,
+                                               args=(function, args, task, kwargs, child_conn))
+                proc.start()
+                # Close our copy of the write end so a crashed worker shows up
+                # as EOF on the read end.
+                child_conn.close()
+                task['start'] = time.time()
+                task['rss'] = 0
+                task['peak_rss'] = 0
+                running[parent_conn] = task
+                procs[parent_conn] = proc
+
+            for conn in wait(list(running), timeout=poll):
+                task = running.pop(conn)
+                proc = procs.pop(conn)
+                try:
+                    result = conn.recv()
+                except EOFError:
+                    proc.join()
+                    result = failed_record(task, 'FAILED',
+                                           'Worker exited with code {}'.format(proc.exitcode))
+                conn.close()
+                proc.join()
+                # Workers that finish between samples have no peak to report.
+                if task['peak_rss']:
+                    result['Peak_RSS_MB'] = task['peak_rss'] / 2**20
+                release(task)
+                yield task, result
+
+            for conn, task in list(running.items()):
+                task['rss'] = process_rss(procs[conn].pid)
+                task['peak_rss'] = max(task['peak_rss'], task['rss'])
+
+                elapsed = time.time() - task['start']
+                if timeout is not None and elapsed > timeout:
+                    status = 'TIMEOUT'
+                    msg = 'Killed after {:.0f} s'.format(elapsed)
+                elif max_rss is not None and task['rss'] > max_rss:
+                    status = 'OOM'
+                    msg = 'Killed at {:.0f} MB resident memory'.format(task['rss'] / 2**20)
+                else:
+                    continue
+
+                del running[conn]
+                kill_process(procs.pop(conn))
+                conn.close()
+                result = failed_record(task, status, msg)
+                result['Peak_RSS_MB'] = task['peak_rss'] / 2**20
+                release(task)
+                yield task, result
+
+    finally:
+        for conn, proc in procs.items():
+            kill_process(proc)
+            conn.close()
+        for task in running.values():
+            release(task)
+        if executor is not None:
+            for future in staged.values():
+                future.cancel()
+            executor.shutdown()
+            for data_file in staged:
+                staging.release(data_file)
@@ -0,0 +1,338 @@
+"""Summary statistics of pipeline products, computed in chunks to keep
+memory bounded on large arrays.
+"""
+
+import numpy as np
+
+try:
+    from jwst.datamodels import dqflags
+    DQ_NAMES = {bit: name for name, bit in dqflags.pixel.items() if bit}
+except ImportError:
+    DQ_NAMES = {}
+
+
+# Number of array elements handled at a time.
+CHUNK_SIZE = 2**22
+
+# Number of histogram bins used for the clipped percentiles.
+NBINS = 4096
+
+
+def _chunks(array, chunk_size=CHUNK_SIZE):
+    """Yield a flattened array in chunks."""
+
+    flat = array.reshape(-1)
+    for start in range(0, flat.size, chunk_size):
+        yield flat[start:start + chunk_size]
+
+
+def dq_counts(array, chunk_size=CHUNK_SIZE):
+    """Number of elements with each DQ bit set.
+
+    Parameters
+    ----------
+    array: numpy.ndarray
+        Integer DQ array.
+    chunk_size: int
+        Number of elements handled at a time.
+
+    Returns
+    -------
+    counts: dict
+        Count of every bit that is set anywhere, keyed by flag name (or bit
+        value if the name is unknown).
+    """
+
+    nbits = array.dtype.itemsize * 8
+    counts = np.zeros(nbits, dtype=np.int64)
+    bits = np.left_shift(np.uint64(1), np.arange(nbits, dtype=np.uint64))
+    for chunk in _chunks(array, chunk_size):
+        chunk = chunk.astype(np.uint64)
+        for i, bit in enumerate(bits):
+            counts[i] += np.count_nonzero(chunk & bit)
+
+    return {DQ_NAMES.get(int(bit), str(int(bit))): int(count)
+            for bit, count in zip(bits, counts) if count}
+
+
+def _clipped_moments(array, low, high, chunk_size=CHUNK_SIZE, nbins=None):
+    """Count, mean and standard deviation of the finite values of an array
+    within [low, high] and, if nbins is given, their histogram over that range.
+    """
+
+    hist = np.zeros(nbins, dtype=np.int64) if nbins else None
+    count = 0
+    total = total_sq = 0.
+    for chunk in _chunks(array, chunk_size):
+        chunk = chunk.astype(np.float64)
+        values = chunk[np.isfinite(chunk) & (chunk >= low) & (chunk <= high)]
+        count += values.size
+        total += values.sum()
+        total_sq += np.square(values).sum()
+        if nbins:
+            hist += np.histogram(values, bins=nbins, range=(low, high))[0]
+
+    if count == 0:
+        return 0, None, None, hist
+
+    mean = total / count
+
+    return count, mean, np.sqrt(max(total_sq / count - mean**2, 0.)), hist
+
+
+def array_stats(array, sigma=3., chunk_size=CHUNK_SIZE):
+    """NaN/inf fractions and sigma clipped statistics of an array.
+
+    The first pass collects the NaN/inf counts and the mean and standard
+    deviation of the finite values, the second the mean and standard
+    deviation of the values within sigma standard deviations of those. The
+    third pass clips again around the second mean, so a few extreme
+    outliers can't stretch the range, and builds a histogram from which the
+    median and percentiles are read to within one bin. The mean and std
+    reported are those of the values kept in the third pass.
+
+    Parameters
+    ----------
+    array: numpy.ndarray
+        Numeric array.
+    sigma: float
+        Clipping limit in standard deviations.
+    chunk_size: int
+        Number of elements handled at a time.
+
+    Returns
+    -------
+    stats: dict
+        nan_fraction, inf_fraction and the clipped mean, std, median, p05
+        and p95.
+    """
+
+    size = array.size
+    stats = {'shape': list(array.shape)}
+    if size == 0:
+        return stats
+
+    nans = infs = 0
+    for chunk in _chunks(array, chunk_size):
+        nans += np.count_nonzero(np.isnan(chunk))
+        infs += np.count_nonzero(np.isinf(chunk))
+
+    stats['nan_fraction'] = float(nans) / size
+    stats['inf_fraction'] = float(infs) / size
+
+    count, mean, std, _ = _clipped_moments(array, -np.inf, np.inf, chunk_size)
+    if count == 0:
+        return stats
+
+    # Once clipped moments, the histogram range follows from these.
+    count, mean, std, _ = _clipped_moments(array, mean - sigma * std, mean + sigma * std,
+                                           chunk_size)
+    low, high = mean - sigma * std, mean + sigma * std
+    if std == 0:
+        low, high = mean - 0.5, mean + 0.5
+
+    clipped, mean, std, hist = _clipped_moments(array, low, high, chunk_size, nbins=NBINS)
+
+    edges = np.linspace(low, high, NBINS + 1)
+    cumulative = np.cumsum(hist)
+    for name, q in [('p05', 0.05), ('median', 0.5), ('p95', 0.95)]:
+        # Interpolate within the bin holding the quantile.
+        target = q * clipped
+        i = min(np.searchsorted(cumulative, target), NBINS - 1)
+        before = cumulative[i - 1] if i else 0
+        fraction = (target - before) / hist[i] if hist[i] else 0.
+        stats[name] = float(edges[i] + fraction * (edges[i + 1] - edges[i]))
+
+    stats['mean'] = float(mean)
+    stats['std'] = float(std)
+
+    return stats
+
+
+def _arrays(model):
+    """Numeric top level arrays of a datamodel keyed by attribute name."""
+
+    return {name: value for name, value in model.instance.items()
+            if isinstance(value, np.ndarray) and value.dtype.kind in 'iuf'}
+
+
+def _is_dq(name, array):
+    return 'dq' in name and array.dtype.kind in 'iu'
+
+
+def product_stats(model, chunk_size=CHUNK_SIZE):
+    """Statistics of every array of a datamodel.
+
+    Parameters
+    ----------
+    model: jwst.datamodels.DataModel
+        Pipeline product, or a container of them.
+    chunk_size: int
+        Number of elements handled at a time.
+
+    Returns
+    -------
+    stats: dict
+        For every array attribute, DQ bit counts for DQ arrays or the
+        output of array_stats for everything else. Containers give a list
+        with one dictionary per model.
+    """
+
+    if not hasattr(model, 'instance'):
+        return [product_stats(item, chunk_size) for item in model]
+
+    stats = {}
+    for name, array in sorted(_arrays(model).items()):
+        if _is_dq(name, array):
+            stats[name] = dq_counts(array, chunk_size)
+        else:
+            stats[name] = array_stats(array, chunk_size=chunk_size)
+
+    return stats
+
+
+def bad_fraction(stats, name='data'):
+    """Fraction of NaN or inf values of an array in product_stats output,
+    the worst model for containers, or None if the array isn't there.
+    """
+
+    if isinstance(stats, list):
+        fractions = [bad_fraction(item, name) for item in stats]
+        fractions = [fraction for fraction in fractions if fraction is not None]
+        return max(fractions) if fractions else None
+
+    if name not in stats or 'nan_fraction' not in stats[name]:
+        return None
+
+    return stats[name]['nan_fraction'] + stats[name]['inf_fraction']
+
+
+def array_diff(baseline, candidate, chunk_size=CHUNK_SIZE):
+    """Differences between two numeric arrays of the same shape.
+
+    Elements that are NaN in both arrays count as unchanged.
+
+    Parameters
+    ----------
+    baseline: numpy.ndarray
+        Array made with the current reference file.
+    candidate: numpy.ndarray
+        Array made with the reference file under test.
+    chunk_size: int
+        Number of elements handled at a time.
+
+    Returns
+    -------
+    diff: dict
+        max_abs_diff over the elements finite in both, fraction_changed and
+        nan_changed, the number of elements that became or stopped being
+        NaN or inf.
+    """
+
+    changed = nan_changed = 0
+    max_abs_diff = 0.
+    for old, new in zip(_chunks(baseline, chunk_size), _chunks(candidate, chunk_size)):
+        old = old.astype(np.float64)
+        new = new.astype(np.float64)
+        old_finite = np.isfinite(old)
+        new_finite = np.isfinite(new)
+        both = old_finite & new_finite
+        if both.any():
+            max_abs_diff = max(max_abs_diff, float(np.abs(new[both] - old[both]).max()))
+        changed += np.count_nonzero(~((old == new) | (np.isnan(old) & np.isnan(new))))
+        nan_changed += np.count_nonzero(old_finite != new_finite)
+
+    return {'max_abs_diff': max_abs_diff,
+            'fraction_changed': float(changed) / baseline.size if baseline.size else 0.,
+            'nan_changed': int(nan_changed)}
+
+
+def dq_diff(baseline, candidate, chunk_size=CHUNK_SIZE):
+    """Changes between two DQ arrays of the same shape.
+
+    Parameters
+    ----------
+    baseline: numpy.ndarray
+        DQ array made with the current reference file.
+    candidate: numpy.ndarray
+        DQ array made with the reference file under test.
+    chunk_size: int
+        Number of elements handled at a time.
+
+    Returns
+    -------
+    diff: dict
+        fraction_changed, the fraction of pixels whose DQ value changed, and
+        per flag the number of pixels that gained ('+') or lost ('-') it.
+    """
+
+    nbits = max(baseline.dtype.itemsize, candidate.dtype.itemsize) * 8
+    bits = np.left_shift(np.uint64(1), np.arange(nbits, dtype=np.uint64))
+    gained = np.zeros(nbits, dtype=np.int64)
+    lost = np.zeros(nbits, dtype=np.int64)
+    changed = 0
+    for old, new in zip(_chunks(baseline, chunk_size), _chunks(candidate, chunk_size)):
+        flipped = old.astype(np.uint64) ^ new.astype(np.uint64)
+        changed += np.count_nonzero(flipped)
+        new = new.astype(np.uint64)
+        for i, bit in enumerate(bits):
+            flipped_bit = (flipped & bit).astype(bool)
+            now_set = flipped_bit & (new & bit).astype(bool)
+            gained[i] += np.count_nonzero(now_set)
+            lost[i] += np.count_nonzero(flipped_bit) - np.count_nonzero(now_set)
+
+    diff = {'fraction_changed': float(changed) / baseline.size if baseline.size else 0.}
+    for bit, plus, minus in zip(bits, gained, lost):
+        name = DQ_NAMES.get(int(bit), str(int(bit)))
+        if plus:
+            diff['+' + name] = int(plus)
+        if minus:
+            diff['-' + name] = int(minus)
+
+    return diff
+
+
+def compare_products(baseline, candidate, chunk_size=CHUNK_SIZE):
+    """Compare every array of a candidate product with the baseline.
+
+    Parameters
+    ----------
+    baseline: jwst.datamodels.DataModel
+        Product made with the current reference file, or a container.
+    candidate: jwst.datamodels.DataModel
+        Product made with the reference file under test, or a container.
+    chunk_size: int
+        Number of elements handled at a time.
+
+    Returns
+    -------
+    comparison: dict
+        For every array the output of dq_diff for DQ arrays or array_diff
+        for everything else. Arrays missing from one product or whose shapes
+        differ are reported as such. Containers give a list with one
+        dictionary per model.
+    """
+
+    if not hasattr(candidate, 'instance'):
+        if len(baseline) != len(candidate):
+            return {'error': 'baseline has {} products, candidate {}'.format(
+                len(baseline), len(candidate))}
+        return [compare_products(old, new, chunk_size) for old, new in zip(baseline, candidate)]
+
+    old_arrays = _arrays(baseline)
+    new_arrays = _arrays(candidate)
+    comparison = {}
+    for name in sorted(set(old_arrays) | set(new_arrays)):
+        if name not in new_arrays:
+            comparison[name] = {'error': 'missing from candidate'}
+        elif name not in old_arrays:
+            comparison[name] = {'error': 'missing from baseline'}
+        elif old_arrays[name].shape != new_arrays[name].shape:
+            comparison[name] = {'error': 'shape changed from {} to {}'.format(
+                old_arrays[name].shape, new_arrays[name].shape)}
+        elif _is_dq(name, new_arrays[name]):
+            comparison[name] = dq_diff(old_arrays[name], new_arrays[name], chunk_size)
+        else:
+            comparison[name] = array_diff(old_arrays[name], new_arrays[name], chunk_size)
+
+    return comparison
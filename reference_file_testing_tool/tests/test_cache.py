@@ -0,0 +1,132 @@
+import os
+import time
+
+from ..cache import ResultCache, StagingCache, make_key
+
+
+DAY = 86400
+
+
+def age(path, days):
+    """Set the mtime of path to days ago."""
+
+    mtime = time.time() - days * DAY
+    os.utime(path, (mtime, mtime))
+
+
+def test_result_cache_get_put(tmpdir):
+    cache = ResultCache(str(tmpdir))
+    key = make_key('ref.fits', 'data_uncal.fits', '1.0')
+
+    assert cache.get(key) is None
+    cache.put(key, {'Test_Status': 'PASSED', 'Duration': 1.5})
+
+    assert cache.get(key) == {'Test_Status': 'PASSED', 'Duration': 1.5}
+    assert ResultCache(str(tmpdir)).get(key) == {'Test_Status': 'PASSED', 'Duration': 1.5}
+    assert os.listdir(cache.cache_dir) == ['{}.json'.format(key)]
+
+
+def test_result_cache_corrupt_entry(tmpdir):
+    cache = ResultCache(str(tmpdir))
+    with open(cache._path('bad'), 'w') as f:
+        f.write('{"Test_Status": "PAS')
+
+    assert cache.get('bad') is None
+
+
+def test_result_cache_expired_get(tmpdir):
+    cache = ResultCache(str(tmpdir), max_age=1)
+    cache.put('old', {'Test_Status': 'PASSED'})
+    age(cache._path('old'), 2)
+
+    assert cache.get('old') is None
+    assert not os.path.exists(cache._path('old'))
+
+
+def test_disk_cache_evict_age(tmpdir):
+    cache = ResultCache(str(tmpdir), max_age=1)
+    for key in ('new', 'old', 'older'):
+        cache.put(key, {'Test_Status': 'PASSED'})
+    age(cache._path('old'), 1.5)
+    age(cache._path('older'), 10)
+
+    cache.evict()
+
+    assert os.listdir(cache.cache_dir) == ['new.json']
+
+
+def test_disk_cache_evict_size(tmpdir):
+    # Room for two entries of about 1 kB.
+    cache = ResultCache(str(tmpdir), max_size=2.5 * 2**10 / 2**20)
+    for days, key in enumerate(['c', 'b', 'a']):
+        cache.put(key, {'data': 'x' * 1000})
+        age(cache._path(key), days)
+
+    cache.evict()
+
+    assert sorted(os.listdir(cache.cache_dir)) == ['b.json', 'c.json']
+
+
+def make_source(tmpdir, name, size=1024):
+    path = os.path.join(str(tmpdir), name)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+
+    return path
+
+
+def test_staging_cache_reuses_copy(tmpdir):
+    source = make_source(tmpdir, 'a_uncal.fits')
+    cache = StagingCache(os.path.join(str(tmpdir), 'cache'))
+
+    path = cache.stage(source)
+
+    assert os.path.basename(path) == 'a_uncal.fits'
+    assert open(path, 'rb').read() == open(source, 'rb').read()
+    assert cache.stage(source) == path
+
+
+def test_staging_cache_fingerprint(tmpdir):
+    source = make_source(tmpdir, 'a_uncal.fits')
+    cache = StagingCache(os.path.join(str(tmpdir), 'cache'))
+    first = cache.stage(source)
+
+    # A new size means a new copy.
+    make_source(tmpdir, 'a_uncal.fits', size=2048)
+    second = cache.stage(source)
+    assert second != first
+    assert os.path.getsize(second) == 2048
+
+    # So does a new modification time.
+    age(source, 1)
+    third = cache.stage(source)
+    assert third not in (first, second)
+    assert os.path.getsize(third) == 2048
+
+
+def test_staging_cache_evicts_lru_unpinned(tmpdir):
+    # Room for two copies of 1 kB.
+    cache = StagingCache(os.path.join(str(tmpdir), 'cache'), max_size=2.5 * 2**10 / 2**20)
+    sources = [make_source(tmpdir, '{}_uncal.fits'.format(name)) for name in 'abcd']
+
+    def stage(days, source):
+        path = cache.stage(source)
+        age(os.path.dirname(path), days)
+        return path
+
+    a = stage(3, sources[0])
+    b = stage(2, sources[1])
+    cache.release(sources[1])
+    # a is the least recently used but still pinned, so b goes.
+    c = stage(1, sources[2])
+    assert [os.path.exists(path) for path in (a, b, c)] == [True, False, True]
+
+    # Everything pinned, the cache may grow beyond max_size.
+    d = stage(0, sources[3])
+    assert [os.path.exists(path) for path in (a, c, d)] == [True, True, True]
+
+    # Released copies go least recently used first.
+    for source in sources:
+        cache.release(source)
+    cache.evict()
+    assert [os.path.exists(path) for path in (a, c, d)] == [False, True, True]
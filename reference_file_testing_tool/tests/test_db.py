@@ -0,0 +1,43 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from .. import db
+
+
+@pytest.fixture
+def session():
+    engine = create_engine('sqlite://')
+    db.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+
+    # RegressionData reads its columns from the FITS file, insert the rows directly.
+    for filename in ('a_uncal.fits', 'b_uncal.fits'):
+        session.execute(db.RegressionData.__table__.insert().values(
+            filename=filename, path='/data', NINTS='3', NGROUPS='10'))
+    session.add_all([db.MiniData(filename='a_mini5g_uncal.fits', path='/minis',
+                                 parent_filename='a_uncal.fits', NINTS='1', NGROUPS='5'),
+                     db.MiniData(filename='b_mini5g_uncal.fits', path='/minis',
+                                 parent_filename='b_uncal.fits', NINTS='1', NGROUPS='5')])
+    session.commit()
+
+    yield session
+
+    session.close()
+
+
+def test_parent_datasets(session):
+    data_files = ['/minis/a_mini5g_uncal.fits', '/data/a_uncal.fits',
+                  '/minis/b_mini5g_uncal.fits', '/data/c_uncal.fits']
+
+    # Minis map to their parents, duplicates go and unknown files stay.
+    assert db.parent_datasets(session, data_files, chunk_size=1) == \
+        ['/data/a_uncal.fits', '/data/b_uncal.fits', '/data/c_uncal.fits']
+
+
+def test_lookup_minis(session):
+    minis = db.lookup_minis(session, ['/other/a_uncal.fits', '/data/c_uncal.fits'])
+
+    assert list(minis) == ['/other/a_uncal.fits']
+    assert minis['/other/a_uncal.fits']['filename'] == 'a_mini5g_uncal.fits'
+    assert minis['/other/a_uncal.fits']['NGROUPS'] == '5'
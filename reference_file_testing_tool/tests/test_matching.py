@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+
+from ..matching import (best_references, crds_bool, header_conditions, parse_dates,
+                        pattern_mask, selection_table)
+
+
+HEADER = {'name': 'jwst_nircam_flat_0001.rmap',
+          'parkey': (('META.INSTRUMENT.DETECTOR', 'META.INSTRUMENT.FILTER'),
+                     ('META.OBSERVATION.DATE', 'META.OBSERVATION.TIME'))}
+
+
+def make_frame(rows):
+    return pd.DataFrame(rows, columns=['DETECTOR', 'FILTER', 'DATE_OBS', 'TIME_OBS'])
+
+
+def test_selection_table_match_useafter():
+    selector = ('Match', [(('NRCA1', 'F200W'), ('UseAfter', [('2016-01-01 00:00:00', 'a.fits'),
+                                                             ('2017-01-01 00:00:00', 'b.fits')])),
+                          (('NRCA1', 'N/A'), 'c.fits')])
+
+    params, entries = selection_table(HEADER, selector)
+
+    assert params == ('META.INSTRUMENT.DETECTOR', 'META.INSTRUMENT.FILTER')
+    assert entries == [(('NRCA1', 'F200W'), '2016-01-01 00:00:00', 'a.fits'),
+                       (('NRCA1', 'F200W'), '2017-01-01 00:00:00', 'b.fits'),
+                       (('NRCA1', 'N/A'), None, 'c.fits')]
+
+
+def test_selection_table_useafter_only():
+    params, entries = selection_table({'name': 'x.rmap'},
+                                      ('UseAfter', [('2016-01-01 00:00:00', 'a.fits')]))
+
+    assert params == ()
+    assert entries == [((), '2016-01-01 00:00:00', 'a.fits')]
+
+
+def test_pattern_mask():
+    values = np.array(['F200W', 'F150W', 'CLEAR'], dtype=object)
+
+    mask, weight = pattern_mask('F200W|F150W|', values)
+    assert mask.tolist() == [True, True, False]
+    assert weight == 1
+
+    mask, weight = pattern_mask('^F.*W$', values)
+    assert mask.tolist() == [True, True, False]
+    assert weight == 1
+
+    assert pattern_mask('N/A', values) == (None, 0)
+    assert pattern_mask('F200W', None) == (None, 0)
+
+
+def test_parse_dates_mixed_formats():
+    dates = parse_dates(['2015-06-01T00:00:00', '2016-01-01 00:00:00',
+                         '2017-03-04 05:06:07.123', None])
+
+    assert dates[:3].tolist() == [pd.Timestamp('2015-06-01'), pd.Timestamp('2016-01-01'),
+                                  pd.Timestamp('2017-03-04 05:06:07.123')]
+    assert pd.isnull(dates[3])
+
+
+def test_best_references_useafter():
+    # The file under test comes first with an ISO useafter, as in find_matches.
+    params = ('META.INSTRUMENT.DETECTOR',)
+    entries = [(('NRCA1',), '2015-06-01T00:00:00', 'test.fits'),
+               (('NRCA1',), '2014-01-01 00:00:00', 'old.fits'),
+               (('NRCA1',), '2016-01-01 00:00:00', 'new.fits')]
+    frame = make_frame([('NRCA1', 'F200W', '2017-01-01', '00:00:00.5'),
+                        ('NRCA1', 'F200W', '2015-07-01', '00:00:00'),
+                        ('NRCA1', 'F200W', '2014-06-01', '12:00:00.25'),
+                        ('NRCA1', 'F200W', '2013-01-01', '00:00:00')])
+
+    bestrefs = best_references(params, entries, frame)
+
+    assert bestrefs.tolist() == ['new.fits', 'test.fits', 'old.fits', None]
+
+
+def test_best_references_specificity():
+    params = ('META.INSTRUMENT.DETECTOR', 'META.INSTRUMENT.FILTER')
+    entries = [(('NRCA1', 'N/A'), '2016-01-01 00:00:00', 'generic.fits'),
+               (('NRCA1', 'F200W'), '2015-01-01 00:00:00', 'f200w.fits'),
+               (('NRCB1', 'F200W|F150W'), '2015-01-01 00:00:00', 'nrcb1.fits')]
+    frame = make_frame([('NRCA1', 'F200W', '2017-01-01', '00:00:00'),
+                        ('NRCA1', 'F150W', '2017-01-01', '00:00:00'),
+                        ('NRCB1', 'F150W', '2017-01-01', '00:00:00'),
+                        ('NRCB1', 'CLEAR', '2017-01-01', '00:00:00')])
+
+    bestrefs = best_references(params, entries, frame)
+
+    assert bestrefs.tolist() == ['f200w.fits', 'generic.fits', 'nrcb1.fits', None]
+
+
+def test_best_references_no_entries():
+    frame = make_frame([('NRCA1', 'F200W', '2017-01-01', '00:00:00')])
+
+    assert best_references((), [], frame).tolist() == [None]
+
+
+def test_header_conditions():
+    assert header_conditions(HEADER) == []
+    assert header_conditions(dict(HEADER, rmap_relevance='always')) == []
+
+    header = dict(HEADER, rmap_relevance='((EXP_TYPE != "NRS_DARK"))',
+                  substitutions=[('META.SUBARRAY.NAME', [('GENERIC', 'N/A')])])
+    assert header_conditions(header) == ['rmap_relevance', 'substitutions']
+
+
+def test_crds_bool():
+    assert [crds_bool(value) for value in (True, 'TRUE', '1', 'T', False, '0', 'f')] == \
+        ['T', 'T', 'T', 'T', 'F', 'F', 'F']
+    assert crds_bool('N/A') == 'N/A'
+
+
+def test_best_references_boolean():
+    # SQLite returns booleans as '1'/'0', the file under test holds True.
+    params = ('META.VISIT.TSOVISIT',)
+    entries = [((True,), None, 'test.fits'),
+               (('F',), None, 'not_tso.fits')]
+    frame = pd.DataFrame({'TSOVISIT': ['1', '0', None],
+                          'DATE_OBS': ['2017-01-01'] * 3,
+                          'TIME_OBS': ['00:00:00'] * 3})
+
+    bestrefs = best_references(params, entries, frame)
+
+    assert bestrefs.tolist() == ['test.fits', 'not_tso.fits', None]
+
+
+def test_best_references_boolean_or_pattern():
+    params = ('META.VISIT.TSOVISIT',)
+    entries = [(('T|F|',), None, 'any.fits')]
+    frame = pd.DataFrame({'TSOVISIT': ['1', '0'],
+                          'DATE_OBS': ['2017-01-01'] * 2,
+                          'TIME_OBS': ['00:00:00'] * 2})
+
+    assert best_references(params, entries, frame).tolist() == ['any.fits', 'any.fits']
@@ -0,0 +1,76 @@
+import os
+
+from astropy.io import fits
+import numpy as np
+import pytest
+
+from ..mini import derive_mini, mini_filename
+
+
+@pytest.fixture
+def uncal_file(tmpdir):
+    nints, ngroups, ny, nx = 3, 10, 6, 8
+    primary = fits.PrimaryHDU()
+    primary.header.update({'NINTS': nints, 'NGROUPS': ngroups, 'INTSTART': 1, 'INTEND': nints,
+                           'SUBARRAY': 'SUB6X8', 'SUBSIZE1': nx, 'SUBSIZE2': ny})
+    sci = np.arange(nints * ngroups * ny * nx, dtype=np.uint16).reshape(nints, ngroups, ny, nx)
+    group = fits.BinTableHDU.from_columns(
+        [fits.Column(name='integration_number', format='I',
+                     array=np.repeat(np.arange(1, nints + 1), ngroups)),
+         fits.Column(name='group_number', format='I',
+                     array=np.tile(np.arange(1, ngroups + 1), nints))],
+        name='GROUP')
+    hdulist = fits.HDUList([primary,
+                            fits.ImageHDU(sci, name='SCI'),
+                            fits.ImageHDU(sci[:, 0] + 1, name='ZEROFRAME'),
+                            fits.ImageHDU(np.zeros((ny, nx), dtype=np.uint32), name='PIXELDQ'),
+                            fits.ImageHDU(sci[..., :2], name='REFOUT'),
+                            group])
+
+    filename = os.path.join(str(tmpdir), 'jw00001001001_01101_00001_nrca1_uncal.fits')
+    hdulist.writeto(filename)
+
+    return filename
+
+
+def test_mini_filename():
+    assert mini_filename('/data/jw001_nrca1_uncal.fits', 5) == 'jw001_nrca1_mini5g_uncal.fits'
+    assert mini_filename('/data/jw001_nrca1_uncal.fits', 5, crop=64) == \
+        'jw001_nrca1_mini5g64px_uncal.fits'
+    assert mini_filename('/data/jw001_nrca1.fits', 2) == 'jw001_nrca1_mini2g.fits'
+
+
+def test_derive_mini(uncal_file, tmpdir):
+    out_dir = tmpdir.mkdir('minis')
+
+    mini_file = derive_mini(uncal_file, str(out_dir), ngroups=5)
+
+    assert mini_file == os.path.join(str(out_dir), mini_filename(uncal_file, 5))
+    with fits.open(uncal_file) as parent, fits.open(mini_file) as mini:
+        assert np.array_equal(mini['SCI'].data, parent['SCI'].data[:1, :5])
+        assert np.array_equal(mini['ZEROFRAME'].data, parent['ZEROFRAME'].data[:1])
+        assert mini['PIXELDQ'].data.shape == (6, 8)
+        assert mini['REFOUT'].data.shape == (1, 5, 6, 2)
+        assert mini['GROUP'].data['integration_number'].tolist() == [1] * 5
+        assert mini['GROUP'].data['group_number'].tolist() == [1, 2, 3, 4, 5]
+
+        header = mini[0].header
+        assert (header['NINTS'], header['NGROUPS'], header['INTEND']) == (1, 5, 1)
+        assert (header['SUBARRAY'], header['SUBSIZE1'], header['SUBSIZE2']) == ('SUB6X8', 8, 6)
+        assert 'jw00001001001_01101_00001_nrca1_uncal.fits' in str(header['HISTORY'])
+
+
+def test_derive_mini_crop(uncal_file, tmpdir):
+    # More groups than the file has keeps all of them.
+    mini_file = derive_mini(uncal_file, str(tmpdir), ngroups=20, crop=4)
+
+    with fits.open(uncal_file) as parent, fits.open(mini_file) as mini:
+        assert np.array_equal(mini['SCI'].data, parent['SCI'].data[:1, :, :4, :4])
+        assert mini['ZEROFRAME'].data.shape == (1, 4, 4)
+        assert mini['PIXELDQ'].data.shape == (4, 4)
+        assert 'REFOUT' not in mini
+        assert len(mini['GROUP'].data) == 10
+
+        header = mini[0].header
+        assert (header['NINTS'], header['NGROUPS']) == (1, 10)
+        assert (header['SUBARRAY'], header['SUBSIZE1'], header['SUBSIZE2']) == ('GENERIC', 4, 4)
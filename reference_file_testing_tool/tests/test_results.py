@@ -0,0 +1,76 @@
+import os
+
+from ..results import (ResultWriter, merge_results, read_results, report_records,
+                       summarize_steps)
+
+
+RECORDS = [{'Path': '/data', 'Filename': 'a_uncal.fits', 'Test_Status': 'PASSED',
+            'Error_Msg': None, 'Duration': 12.5, 'Peak_RSS_MB': 800.,
+            'Step_Stats': [{'step': 'dq_init', 'wall': 1., 'cpu': 0.5, 'peak_rss_delta_mb': 10.}]},
+           {'Path': '/data', 'Filename': 'b_uncal.fits', 'Test_Status': 'FAILED',
+            'Error_Msg': 'boom', 'Duration': 3., 'Step_Stats': []}]
+
+
+def write(filename, records):
+    with ResultWriter(filename) as writer:
+        for record in records:
+            writer.write(record)
+
+
+def test_csv_round_trip(tmpdir):
+    filename = os.path.join(str(tmpdir), 'results.csv')
+    write(filename, RECORDS)
+
+    assert read_results(filename) == RECORDS
+
+
+def test_csv_and_jsonl_reports_match(tmpdir):
+    csv_file = os.path.join(str(tmpdir), 'results.csv')
+    jsonl_file = os.path.join(str(tmpdir), 'results.jsonl')
+    write(csv_file, RECORDS)
+    write(jsonl_file, RECORDS)
+
+    csv_records = read_results(csv_file)
+    jsonl_records = read_results(jsonl_file)
+
+    assert report_records(csv_records) == report_records(jsonl_records)
+    assert summarize_steps(csv_records) == summarize_steps(jsonl_records)
+
+
+def test_truncated_jsonl(tmpdir):
+    filename = os.path.join(str(tmpdir), 'results.jsonl')
+    write(filename, RECORDS)
+    with open(filename, 'a') as f:
+        f.write('{"Path": "/da')
+
+    assert read_results(filename) == RECORDS
+
+
+def test_merge_results(tmpdir, capsys):
+    first = os.path.join(str(tmpdir), 'shard0.jsonl')
+    second = os.path.join(str(tmpdir), 'shard1.csv')
+    merged = os.path.join(str(tmpdir), 'merged.jsonl')
+    write(first, RECORDS[:1])
+    write(second, RECORDS[1:])
+
+    tab_data = merge_results([first, second], output=merged)
+
+    assert tab_data == RECORDS
+    assert read_results(merged) == RECORDS
+    out = capsys.readouterr().out
+    assert 'Merged 2 results (1 FAILED, 1 PASSED)' in out
+    assert 'WARNING' not in out
+
+
+def test_merge_results_duplicates(tmpdir, capsys):
+    first = os.path.join(str(tmpdir), 'shard0.jsonl')
+    second = os.path.join(str(tmpdir), 'shard1.jsonl')
+    write(first, RECORDS)
+    write(second, RECORDS[1:])
+
+    tab_data = merge_results([first, second])
+
+    assert len(tab_data) == 3
+    out = capsys.readouterr().out
+    assert out.count('WARNING') == 1
+    assert '/data/b_uncal.fits appears in more than one result file' in out
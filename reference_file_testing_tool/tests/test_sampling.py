@@ -0,0 +1,105 @@
+from ..sampling import EarlyStopper, error_signature, order_in_waves, sample_coverage
+
+
+def make_batch(rows):
+    """Tasks and datasets from (data_file, detector, filter, estimate) rows."""
+
+    tasks = [{'data_file': data_file, 'estimate': estimate}
+             for data_file, _, _, estimate in rows]
+    datasets = {data_file: {'EXP_TYPE': 'NRC_IMAGE', 'DETECTOR': detector, 'FILTER': filt}
+                for data_file, detector, filt, _ in rows}
+
+    return tasks, datasets
+
+
+def files(tasks):
+    return [task['data_file'] for task in tasks]
+
+
+def test_sample_coverage_cheapest_per_mode():
+    tasks, datasets = make_batch([('a1', 'NRCA1', 'F200W', 30.),
+                                  ('a2', 'NRCA1', 'F200W', 10.),
+                                  ('a3', 'NRCA1', 'F200W', 20.),
+                                  ('b1', 'NRCB1', 'F150W', 50.),
+                                  ('b2', 'NRCB1', 'F150W', 40.)])
+
+    assert sorted(files(sample_coverage(tasks, datasets, 2))) == ['a2', 'b2']
+
+
+def test_sample_coverage_new_values_first():
+    # b is the cheapest, after it c adds two new keyword values and a only one.
+    tasks, datasets = make_batch([('a', 'NRCA1', 'F200W', 10.),
+                                  ('b', 'NRCA1', 'F150W', 1.),
+                                  ('c', 'NRCB1', 'F444W', 100.)])
+
+    assert files(sample_coverage(tasks, datasets, 2)) == ['b', 'c']
+
+
+def test_sample_coverage_leftover_budget():
+    tasks, datasets = make_batch([('a1', 'NRCA1', 'F200W', 30.),
+                                  ('a2', 'NRCA1', 'F200W', 10.),
+                                  ('a3', 'NRCA1', 'F200W', 20.)])
+
+    assert files(sample_coverage(tasks, datasets, 2)) == ['a2', 'a3']
+    assert sorted(files(sample_coverage(tasks, datasets, 10))) == ['a1', 'a2', 'a3']
+
+
+def result(status, msg=None):
+    return {'Test_Status': status, 'Error_Msg': msg}
+
+
+def test_order_in_waves():
+    tasks, datasets = make_batch([('a1', 'NRCA1', 'F200W', 30.),
+                                  ('a2', 'NRCA1', 'F200W', 10.),
+                                  ('a3', 'NRCA1', 'F200W', 20.),
+                                  ('b1', 'NRCB1', 'F150W', 50.),
+                                  ('c1', 'NRCB1', 'F444W', 5.),
+                                  ('c2', 'NRCB1', 'F444W', 1.)])
+
+    # One data set of every mode per wave, cheapest first within a mode,
+    # longest first within a wave.
+    assert files(order_in_waves(tasks, datasets)) == ['b1', 'a2', 'c2', 'a3', 'c1', 'a1']
+
+
+def test_error_signature():
+    first = error_signature('Cannot open /data/jw001_uncal.fits: shape (2048, 2048) != (10, 10)')
+    second = error_signature('Cannot open /other/jw002_uncal.fits: shape (32, 32) != (1.5, 2)')
+
+    assert first == second == 'Cannot open <path> shape (#, #) != (#, #)'
+    assert error_signature(None) == 'None'
+    assert len(error_signature('x' * 1000)) == 200
+
+
+def test_early_stopper_max_failures():
+    tasks, datasets = make_batch([('a{}'.format(n), 'NRCA1', 'F200W', 1.) for n in range(5)])
+    stopper = EarlyStopper(tasks, datasets, max_failures=3)
+
+    assert stopper.update(tasks[0], result('FAILED', 'bad value 1 in /data/a0')) is None
+    assert stopper.update(tasks[1], result('FAILED', 'other error')) is None
+    assert stopper.update(tasks[2], result('PASSED')) is None
+    assert stopper.update(tasks[3], result('FAILED', 'bad value 2 in /data/a3')) is None
+    reason = stopper.update(tasks[4], result('FAILED', 'bad value 3 in /data/a4'))
+    assert reason == '3 data sets failed with: bad value # in <path>'
+
+
+def test_early_stopper_passes_per_mode():
+    # NRCB1 has a single data set, fewer than passes_per_mode.
+    tasks, datasets = make_batch([('a1', 'NRCA1', 'F200W', 1.),
+                                  ('a2', 'NRCA1', 'F200W', 1.),
+                                  ('a3', 'NRCA1', 'F200W', 1.),
+                                  ('b1', 'NRCB1', 'F200W', 1.)])
+    stopper = EarlyStopper(tasks, datasets, passes_per_mode=2)
+
+    assert stopper.update(tasks[0], result('PASSED')) is None
+    assert stopper.update(tasks[3], result('PASSED')) is None
+    assert stopper.update(tasks[1], result('FAILED', 'error')) is None
+    assert stopper.update(tasks[2], result('PASSED')) == \
+        'all 2 observing modes passed at least 2 times'
+
+
+def test_early_stopper_never():
+    tasks, datasets = make_batch([('a1', 'NRCA1', 'F200W', 1.)])
+    stopper = EarlyStopper(tasks, datasets)
+
+    assert stopper.update(tasks[0], result('FAILED', 'error')) is None
+    assert stopper.update(tasks[0], result('PASSED')) is None
@@ -0,0 +1,174 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+from ..scheduler import (DEFAULT_RATES, OVERHEAD, _next_admissible, make_task, parse_shard,
+                         run_tasks, shard_tasks, task_samples)
+
+
+def make_tasks():
+    tasks = []
+    for n in range(23):
+        keywords = {'NINTS': 1 + n % 3, 'NGROUPS': 5 + 7 * n % 11,
+                    'SUBSIZE1': 2048 if n % 4 else 512, 'SUBSIZE2': 2048 if n % 4 else 512}
+        pipeline = ['dark', 'detector1', 'image', 'spec'][n % 4]
+        tasks.append(make_task('/data/{:02d}_uncal.fits'.format(n), keywords, pipeline))
+
+    return tasks
+
+
+def cost(task):
+    return OVERHEAD + DEFAULT_RATES[task['pipeline']] * task_samples(task)
+
+
+def test_parse_shard():
+    assert parse_shard('0/1') == (0, 1)
+    assert parse_shard('2/3') == (2, 3)
+
+
+@pytest.mark.parametrize('shard', ['3/3', '-1/2', '1/0', '0/-1', 'a/b', '1', '1/2/3', ''])
+def test_parse_shard_rejects(shard):
+    with pytest.raises(ValueError):
+        parse_shard(shard)
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 5, 30])
+def test_shard_tasks_partition(count):
+    tasks = make_tasks()
+
+    shards = [shard_tasks(tasks, index, count) for index in range(count)]
+
+    files = [task['data_file'] for shard in shards for task in shard]
+    assert sorted(files) == sorted(task['data_file'] for task in tasks)
+    assert len(set(files)) == len(files)
+    # Each shard keeps the original order.
+    for shard in shards:
+        assert shard == [task for task in tasks if task in shard]
+
+
+def test_shard_tasks_deterministic():
+    tasks = make_tasks()
+
+    # Another host may list the data sets in another order.
+    first = shard_tasks(tasks, 1, 3)
+    second = shard_tasks(tasks[::-1], 1, 3)
+
+    assert sorted(task['data_file'] for task in first) == \
+        sorted(task['data_file'] for task in second)
+
+
+def test_shard_tasks_balanced():
+    tasks = make_tasks()
+    count = 4
+
+    loads = [sum(cost(task) for task in shard_tasks(tasks, index, count))
+             for index in range(count)]
+
+    # Longest first dealing keeps every shard within the largest task of the mean.
+    mean = sum(loads) / count
+    assert max(loads) - mean <= max(cost(task) for task in tasks)
+
+
+# Workers run in another process, so these live at module level.
+
+def passed(data_file, output_dir=None):
+    with open(os.path.join(output_dir, 'product.fits'), 'w') as f:
+        f.write('product')
+    return {'Path': os.path.dirname(data_file), 'Filename': os.path.basename(data_file),
+            'Test_Status': 'PASSED', 'Error_Msg': None, 'Output_Dir': output_dir}
+
+
+def sleep(data_file, output_dir=None):
+    time.sleep(60)
+
+
+def allocate(data_file, output_dir=None):
+    # np.ones touches every page, so all of it is resident.
+    array = np.ones(600 * 2**20 // 8)
+    time.sleep(60)
+    return array
+
+
+def crash(data_file, output_dir=None):
+    os._exit(3)
+
+
+def error(data_file, output_dir=None):
+    raise ValueError('bad data')
+
+
+def run(function, tmpdir, **kwargs):
+    tasks = [make_task('/data/{}_uncal.fits'.format(function.__name__), {}, 'dark')]
+    results = list(run_tasks(function, tasks, 1, poll=0.1, scratch_dir=str(tmpdir), **kwargs))
+
+    assert len(results) == 1
+    # The task's scratch directory is gone however it ended.
+    assert os.listdir(str(tmpdir)) == []
+
+    return results[0][1]
+
+
+def test_run_tasks_passed(tmpdir):
+    result = run(passed, tmpdir)
+
+    assert result['Test_Status'] == 'PASSED'
+    assert result['Output_Dir'].startswith(str(tmpdir))
+
+
+def test_run_tasks_timeout(tmpdir):
+    start = time.time()
+
+    result = run(sleep, tmpdir, timeout=0.5)
+
+    assert result['Test_Status'] == 'TIMEOUT'
+    assert result['Filename'] == 'sleep_uncal.fits'
+    assert time.time() - start < 30
+
+
+def test_run_tasks_oom(tmpdir):
+    result = run(allocate, tmpdir, max_rss=200 * 2**20)
+
+    assert result['Test_Status'] == 'OOM'
+    assert result['Peak_RSS_MB'] > 200
+
+
+def test_run_tasks_worker_crash(tmpdir):
+    result = run(crash, tmpdir)
+
+    assert result['Test_Status'] == 'FAILED'
+    assert result['Error_Msg'] == 'Worker exited with code 3'
+
+
+def test_run_tasks_worker_error(tmpdir):
+    result = run(error, tmpdir)
+
+    assert result['Test_Status'] == 'FAILED'
+    assert result['Error_Msg'] == 'bad data'
+
+
+def test_next_admissible():
+    gb = 2**30
+    pending = [{'data_file': 'big', 'memory': 3 * gb},
+               {'data_file': 'staging', 'memory': gb},
+               {'data_file': 'small', 'memory': gb}]
+    running = {'conn': {'data_file': 'running', 'memory': 2 * gb, 'rss': gb}}
+
+    def ready(task):
+        return task['data_file'] != 'staging'
+
+    # The running task holds 2 GB of the 4, so only the small tasks fit.
+    assert _next_admissible(pending, running, 4 * gb) == 1
+    assert _next_admissible(pending, running, 4 * gb, ready=ready) == 2
+    # Nothing fits while another task runs, wait for it.
+    assert _next_admissible(pending, running, 2 * gb) is None
+
+
+def test_next_admissible_too_big(capsys):
+    pending = [{'data_file': '/data/big_uncal.fits', 'memory': 2**40}]
+
+    # With nothing running the head of the queue runs on its own.
+    assert _next_admissible(pending, {}, 2**30) == 0
+    assert 'WARNING: big_uncal.fits' in capsys.readouterr().out
+    assert _next_admissible(pending, {}, 2**30, ready=lambda task: False) is None
@@ -0,0 +1,76 @@
+import numpy as np
+
+from ..stats import array_diff, array_stats, dq_counts, dq_diff
+
+
+def test_array_stats_outliers():
+    rng = np.random.RandomState(42)
+    array = rng.normal(10., 2., size=(1000, 1000))
+    array.flat[rng.choice(array.size, 100, replace=False)] = 1e6
+
+    stats = array_stats(array, chunk_size=100000)
+
+    assert abs(stats['mean'] - 10.) < 0.01
+    # Clipping at 3 sigma trims the tails a little.
+    assert abs(stats['std'] - 2.) < 0.05
+    assert abs(stats['median'] - 10.) < 0.02
+    assert abs(stats['p05'] - 6.71) < 0.05
+    assert abs(stats['p95'] - 13.29) < 0.05
+
+
+def test_array_stats_nan_inf():
+    array = np.ones(100, dtype=np.float32)
+    array[:10] = np.nan
+    array[10:15] = np.inf
+
+    stats = array_stats(array, chunk_size=7)
+
+    assert stats['nan_fraction'] == 0.1
+    assert stats['inf_fraction'] == 0.05
+    assert stats['mean'] == 1.
+    assert stats['std'] == 0.
+    assert abs(stats['median'] - 1.) < 1e-3
+
+
+def test_array_stats_all_nan():
+    stats = array_stats(np.full((3, 3), np.nan))
+
+    assert stats['nan_fraction'] == 1.
+    assert 'median' not in stats
+
+
+def test_dq_counts():
+    dq = np.zeros((10, 10), dtype=np.uint32)
+    dq[0] = 1
+    dq[1, :5] = 1 | 4
+
+    counts = dq_counts(dq, chunk_size=13)
+
+    assert sorted(counts.values()) == [5, 15]
+
+
+def test_array_diff():
+    baseline = np.arange(100, dtype=np.float32)
+    candidate = baseline.copy()
+    candidate[:3] += 2.
+    baseline[50] = candidate[50] = np.nan
+    candidate[60] = np.nan
+
+    diff = array_diff(baseline, candidate, chunk_size=17)
+
+    assert diff['max_abs_diff'] == 2.
+    assert diff['fraction_changed'] == 0.04
+    assert diff['nan_changed'] == 1
+
+
+def test_dq_diff():
+    baseline = np.zeros(20, dtype=np.uint32)
+    candidate = baseline.copy()
+    baseline[:2] = 2
+    candidate[:4] = 4
+
+    diff = dq_diff(baseline, candidate, chunk_size=3)
+
+    assert diff['fraction_changed'] == 0.2
+    assert sum(value for key, value in diff.items() if key.startswith('+')) == 4
+    assert sum(value for key, value in diff.items() if key.startswith('-')) == 2